@@ -0,0 +1,159 @@
+# Verification of the memory layout of generated structs and unions against the C compiler
+# All of them are checked by one probe program, so it takes one compilation however many there are
+
+import os
+import re
+import subprocess
+import tempfile
+import collections
+
+
+# Sizes of Crystal types in a lib on LP64 platforms; the alignment of each is the same as its size
+_sizes = {
+    'Int8': 1, 'UInt8': 1, 'Int16': 2, 'UInt16': 2, 'Int32': 4, 'UInt32': 4, 'Int64': 8, 'UInt64': 8,
+    'Int128': 16, 'UInt128': 16, 'Float32': 4, 'Float64': 8, 'Bool': 1,
+    'LibC::Char': 1, 'LibC::SChar': 1, 'LibC::Short': 2, 'LibC::UShort': 2, 'LibC::Int': 4, 'LibC::UInt': 4,
+    'LibC::Long': 8, 'LibC::ULong': 8, 'LibC::LongLong': 8, 'LibC::ULongLong': 8,
+    'LibC::Float': 4, 'LibC::Double': 8, 'LibC::SizeT': 8, 'LibC::PtrDiffT': 8,
+}
+_pointer = (8, 8)
+
+
+def _align_up(offset, align):
+    return (offset + align - 1) // align * align
+
+
+# The layouts that the Crystal compiler will give the types of a lib
+# `records` maps names of structs and unions to dicts with 'kind' ('struct' or 'union') and
+# 'members' ([Crystal name, C name, Crystal type] each), `aliases` maps names to types,
+# `enums` and `pointer_types` are sets of names (enums are Int32, see `type X = Void*` for the latter)
+class CrystalLayouts(object):
+    def __init__(self, records, aliases, enums, pointer_types):
+        self.records = records
+        self.aliases = aliases
+        self.enums = enums
+        self.pointer_types = pointer_types
+        self.memo = {}
+
+    def type_layout(self, type, seen=()):
+        # (size, alignment) of a type, or None if it's not known
+        type = type.strip()
+        if type.endswith('*') or '->' in type:
+            # Pointers, including to functions
+            return _pointer
+        m = re.match(r'^(.+)\[([0-9]+)\]$', type)
+        if m:
+            item = self.type_layout(m.group(1), seen)
+            if item is None:
+                return None
+            return item[0] * int(m.group(2)), item[1]
+        if type in _sizes:
+            return _sizes[type], _sizes[type]
+        if type in self.pointer_types:
+            return _pointer
+        if type in self.enums:
+            return 4, 4
+        if type in seen:
+            # An alias of itself
+            return None
+        if type in self.aliases:
+            return self.type_layout(self.aliases[type], seen + (type,))
+        if type in self.records:
+            layout = self.record_layout(type, seen + (type,))
+            return layout and layout[:2]
+
+    def record_layout(self, name, seen=()):
+        # (size, alignment, {C name of member: offset}) of a struct or union, or None if it's not known
+        try:
+            return self.memo[name]
+        except KeyError:
+            pass
+        record = self.records[name]
+        offset = size = 0
+        align = 1
+        offsets = collections.OrderedDict()
+        for crystal_name, c_name, type in record['members']:
+            layout = self.type_layout(type, seen)
+            if layout is None:
+                result = None
+                break
+            if record['kind'] == 'struct':
+                offset = _align_up(offset, layout[1])
+                if c_name:
+                    offsets[c_name] = offset
+                offset += layout[0]
+                size = offset
+            else:
+                if c_name:
+                    offsets[c_name] = 0
+                size = max(size, layout[0])
+            align = max(align, layout[1])
+        else:
+            result = (_align_up(size, align), align, offsets)
+        self.memo[name] = result
+        return result
+
+
+def probe_source(headers, types):
+    # C code of a program that prints the layouts of `types` ([C spelling of the type, [C names of members]] each)
+    # as lines of 'S <index of type> <size> <alignment>' and 'O <index of type> <index of member> <offset>'
+    lines = ['#include "{}"'.format(header) for header in headers]
+    lines += ['#include <stddef.h>', '#include <stdio.h>', '', 'int main(void) {']
+    for i, (c_type, members) in enumerate(types):
+        lines.append('    printf("S {} %zu %zu\\n", sizeof({t}), (size_t)__alignof__({t}));'.format(i, t=c_type))
+        for j, member in enumerate(members):
+            lines.append('    printf("O {} {} %zu\\n", offsetof({}, {}));'.format(i, j, c_type, member))
+    lines += ['    return 0;', '}', '']
+    return '\n'.join(lines)
+
+
+def run_probe(source, root, compiler='gcc'):
+    # Compile and run a probe program, returning its output
+    # The headers are compiled against the real system headers, because sizes are what's being checked
+    fd, exe = tempfile.mkstemp(prefix='crystalize-abi')
+    os.close(fd)
+    try:
+        subprocess.run([compiler, '-w', '-I{}'.format(root), '-x', 'c', '-', '-o', exe],
+                       input=source, universal_newlines=True, check=True, stderr=subprocess.PIPE)
+        return subprocess.check_output([exe], universal_newlines=True)
+    finally:
+        os.unlink(exe)
+
+
+def verify(headers, root, layouts, c_types):
+    # Compare layouts in C with the ones that Crystal will use
+    # `c_types` maps Crystal names of structs and unions to how they are spelled in C (only those that can be)
+    # Returns a list of mismatches and the number of types checked
+    checked = []
+    for name, c_type in c_types.items():
+        layout = layouts.record_layout(name)
+        if layout is not None:
+            checked.append((name, c_type, layout))
+    if not checked:
+        return [], 0
+    types = [(c_type, list(layout[2])) for name, c_type, layout in checked]
+    output = run_probe(probe_source(headers, types), root)
+
+    c_sizes = {}
+    c_offsets = {}
+    for line in output.splitlines():
+        parts = line.split()
+        if parts[0] == 'S':
+            c_sizes[int(parts[1])] = int(parts[2]), int(parts[3])
+        else:
+            c_offsets[int(parts[1]), int(parts[2])] = int(parts[3])
+    mismatches = []
+    for i, (name, c_type, (size, align, offsets)) in enumerate(checked):
+        problems = []
+        c_size, c_align = c_sizes[i]
+        if c_size != size:
+            problems.append("size is {} in C, {} in Crystal".format(c_size, size))
+        if c_align != align:
+            problems.append("alignment is {} in C, {} in Crystal".format(c_align, align))
+        for j, (member, offset) in enumerate(offsets.items()):
+            c_offset = c_offsets[i, j]
+            if c_offset != offset:
+                problems.append("offset of {} is {} in C, {} in Crystal".format(member, c_offset, offset))
+        if problems:
+            mismatches.append("{} ({}): {}".format(name, c_type, '; '.join(problems)))
+    return mismatches, len(checked)
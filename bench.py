@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+
+# Benchmarks for crystalize.py
+# Usage: ./bench.py pipeline [--functions N ...] [--save-baseline]
+#        ./bench.py startup
+#        ./bench.py rewrite [--size MB]
+
+import sys
+import io
+import re
+import json
+import time
+import random
+import shutil
+import subprocess
+import argparse
+import tempfile
+import tracemalloc
+from pathlib import Path
+
+from util import *
+from source import rewrite
+
+
+def rewrite_regex_chain(src):
+    # The directive rewriting as it was done before `source.rewrite`: a chain of passes over the whole source
+    src = '''
+typedef int _DEFINE;
+''' + src
+    src = re.sub(
+        r'^[ \t]*#define +([a-zA-Z_][_a-zA-Z_0-9]*) +(.+)$',
+        lambda m: 'const _DEFINE {} = "{}";'.format(m.group(1), m.group(2).replace('\\', '\\\\').replace('"', '\\"')),
+        src, flags=re.MULTILINE
+    )
+    src = re.sub(r'^[ \t]*#(define|undef).*$', r'', src, flags=re.MULTILINE)
+    lines = []
+    writing = True
+    for line in src.splitlines():
+        m = re.search(r'^[ \t]*#if(n)?.*(!)?', line)
+        if m:
+            writing = bool(m.group(1) or m.group(2))
+            lines.append('')
+        elif re.search(r'^[ \t]*#el', line):
+            writing = not writing
+            lines.append('')
+        elif re.search(r'^[ \t]*#end', line):
+            writing = True
+            lines.append('')
+        else:
+            lines.append(line if writing else '')
+    src = '\n'.join(lines)
+    src = re.sub(r'__attribute__[ \t]*\(\(.+\)\)', '', src)
+    return src
+
+
+def preprocessed_lines(size, seed=0):
+    # Yield lines resembling the output of `gcc -E -dD` until about `size` bytes were produced
+    rand = random.Random(seed)
+    total = 0
+    i = 0
+    while total < size:
+        i += 1
+        chunk = [
+            '# {} "/usr/include/lib/header{}.h"\n'.format(i, i % 50),
+            '#define LIB_CONSTANT_{} {}\n'.format(i, rand.randint(0, 1 << 16)),
+            '#define LIB_STRING_{} "value \\"{}\\""\n'.format(i, i),
+            '#define LIB_MACRO_{}(x) ((x) + {})\n'.format(i, i),
+            '#undef LIB_OLD_{}\n'.format(i),
+            'typedef struct LibThing{0} LibThing{0};\n'.format(i),
+            'struct LibThing{0} {{ int a; float b[{1}]; LibThing{0} *next; }};\n'.format(i, rand.randint(1, 64)),
+            'int lib_function_{0}(LibThing{0} *thing, const char *name, ...) __attribute__((format(printf, 2, 3)));\n'.format(i),
+            '\n',
+        ]
+        for line in chunk:
+            total += len(line)
+            yield line
+
+
+def measure(func):
+    # Returns (seconds, peak bytes allocated); these are measured in separate runs because tracing slows things down
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def bench_rewrite(args):
+    # Both variants consume the preprocessor's output as it comes:
+    # the regex chain needs it as one string, `rewrite` takes it line by line
+    size = int(args.size * 1024 * 1024)
+    old = lambda: rewrite_regex_chain(''.join(preprocessed_lines(size)))
+    new = lambda: rewrite(preprocessed_lines(size))
+    if old().rstrip('\n') != new().rstrip('\n'):
+        err("Warning: results differ")
+    print("Rewriting {:.1f} MB of preprocessed source".format(size / 1024 / 1024))
+    results = [('regex chain', measure(old)), ('single pass', measure(new))]
+    for name, (elapsed, peak) in results:
+        print("  {:<12} {:8.3f} s {:10.1f} MB peak".format(name, elapsed, peak / 1024 / 1024))
+
+
+def synthetic_header(functions=0, structs=0, unions=0, enums=0, callbacks=0, macros=0):
+    # Generate a header with the given numbers of each kind of declaration, referring to each other
+    def ref(prefix, count, i, default):
+        return '{}{}'.format(prefix, i % count) if count else default
+
+    out = ['#ifndef BENCH_H', '#define BENCH_H', '#include <stdint.h>', '#include <stddef.h>', '']
+    for i in range(macros):
+        if i % 3 == 0:
+            out.append('#define BENCH_NAME_{} "bench_{}"'.format(i, i))
+        elif i % 3 == 1:
+            out.append('#define BENCH_FLAG_{} (1u << {})'.format(i, i % 32))
+        else:
+            out.append('#define BENCH_VALUE_{} {}'.format(i, i * 7))
+    for i in range(enums):
+        values = ', '.join('BENCH_E{}_V{} = {}'.format(i, j, j * 2) for j in range(5))
+        out.append('typedef enum {{ {} }} BenchEnum{};'.format(values, i))
+    for i in range(structs):
+        # Forward declaration, then a struct with nested anonymous struct and union
+        out.append('typedef struct BenchStruct{0} BenchStruct{0};'.format(i))
+    for i in range(callbacks):
+        out.append('typedef int (*BenchCallback{})(void *user_data, {} *item, size_t count);'.format(
+            i, ref('BenchStruct', structs, i, 'void')))
+    for i in range(structs):
+        out.append('''struct BenchStruct{0} {{
+    int32_t id;
+    double values[4];
+    struct {{ uint8_t x, y; }} position;
+    union {{ int64_t i; double d; }} data;
+    {1} kind;
+    {2} callback;
+    BenchStruct{0} *next;
+}};'''.format(i, ref('BenchEnum', enums, i, 'int'), ref('BenchCallback', callbacks, i, 'void *')))
+    for i in range(unions):
+        out.append('typedef union BenchUnion{0} {{ int64_t i; double d; char bytes[8]; {1} *ptr; }} BenchUnion{0};'.format(
+            i, ref('BenchStruct', structs, i, 'void')))
+    for i in range(functions):
+        out.append('{} *bench_function_{}(const char *name, {} kind, {} callback, {} value, ...);'.format(
+            ref('BenchStruct', structs, i, 'void'), i, ref('BenchEnum', enums, i, 'int'),
+            ref('BenchCallback', callbacks, i, 'void *'), ref('BenchUnion', unions, i, 'int64_t')))
+    out.append('#endif')
+    return '\n'.join(out) + '\n'
+
+
+_kinds = ['functions', 'structs', 'unions', 'enums', 'callbacks', 'macros']
+
+def bench_pipeline(args):
+    import crystalize
+
+    counts = {kind: getattr(args, kind) for kind in _kinds}
+    tmp = Path(tempfile.mkdtemp())
+    try:
+        header = tmp/'include'/'bench'/'bench.h'
+        header.parent.mkdir(parents=True)
+        with io.open(str(header), 'w') as f:
+            f.write(synthetic_header(**counts))
+
+        # Take the fastest of several runs for each phase
+        best = {}
+        for i in range(args.repeat):
+            stats = Stats()
+            crystalize.crystalize(header, tmp/'include', out=io.StringIO(), stats=stats)
+            for phase, result in stats.phases.items():
+                best[phase] = min(best.get(phase, float('inf')), result['seconds'])
+        declarations = sum(stats.kinds.values())
+    finally:
+        shutil.rmtree(str(tmp))
+
+    print("Pipeline on a synthetic header: {}".format(', '.join('{} {}'.format(n, kind) for kind, n in sorted(counts.items()))))
+    print("{} declarations".format(declarations))
+    results = {'counts': counts, 'declarations': declarations, 'throughput': {}}
+    for phase, seconds in list(best.items()) + [('total', sum(best.values()))]:
+        throughput = declarations / seconds if seconds else float('inf')
+        results['throughput'][phase] = throughput
+        print("  {:<12} {:8.3f} s {:12.0f} declarations/s".format(phase, seconds, throughput))
+
+    baseline_path = Path(args.baseline)
+    if args.save_baseline:
+        with io.open(str(baseline_path), 'w') as f:
+            f.write(json.dumps(results, indent=2, sort_keys=True) + '\n')
+        print("Saved baseline to {}".format(baseline_path))
+    elif baseline_path.is_file():
+        with io.open(str(baseline_path)) as f:
+            baseline = json.load(f)
+        if baseline['counts'] != counts:
+            err("Baseline in {} was measured with different counts; not comparing".format(baseline_path))
+            return 0
+        regressions = 0
+        print("Compared to {}:".format(baseline_path))
+        for phase, throughput in results['throughput'].items():
+            old = baseline['throughput'].get(phase)
+            if not old:
+                continue
+            change = throughput / old - 1
+            regressed = change < -args.threshold
+            regressions += regressed
+            print("  {:<12} {:+7.1%}{}".format(phase, change, "  REGRESSION" if regressed else ""))
+        return 1 if regressions else 0
+
+
+def bench_startup(args):
+    # Start fresh interpreters, as every invocation of the script does
+    commands = [
+        ("--help", [str(here/'crystalize.py'), '--help']),
+        ("first parse", ['-c', 'import sys; sys.path.insert(0, {!r}); import crystalize, util; util.parse_c("int x;")'.format(str(here))]),
+    ]
+    print("Startup time, fastest of {} runs".format(args.repeat))
+    for name, command in commands:
+        best = float('inf')
+        for i in range(args.repeat):
+            start = time.perf_counter()
+            subprocess.check_call([sys.executable] + command, stdout=subprocess.DEVNULL)
+            best = min(best, time.perf_counter() - start)
+        print("  {:<12} {:8.3f} s".format(name, best))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks for crystalize.py")
+    commands = parser.add_subparsers(dest='command')
+
+    command = commands.add_parser('pipeline', help="the whole translation of a synthetic header, with throughput of each phase")
+    for kind, default in zip(_kinds, [2000, 500, 200, 200, 200, 2000]):
+        command.add_argument('--' + kind, type=int, default=default, metavar='N',
+            help="number of {} in the header (default: %(default)s)".format(kind))
+    command.add_argument('--repeat', type=int, default=3, metavar='N',
+        help="run this many times and take the fastest (default: %(default)s)")
+    command.add_argument('--baseline', default=str(here/'bench_baseline.json'), metavar='FILE',
+        help="results to compare with (default: %(default)s)")
+    command.add_argument('--save-baseline', action='store_true',
+        help="store the results as the baseline instead of comparing")
+    command.add_argument('--threshold', type=float, default=0.1, metavar='FRACTION',
+        help="report a regression when throughput drops by more than this (default: %(default)s)")
+    command.set_defaults(func=bench_pipeline)
+
+    command = commands.add_parser('startup', help="time from starting the interpreter until the script is ready")
+    command.add_argument('--repeat', type=int, default=10, metavar='N',
+        help="run this many times and take the fastest (default: %(default)s)")
+    command.set_defaults(func=bench_startup)
+
+    command = commands.add_parser('rewrite', help="directive rewriting of a synthetic preprocessed file")
+    command.add_argument('--size', type=float, default=8, metavar='MB',
+        help="size of the synthetic file (default: %(default)s)")
+    command.set_defaults(func=bench_rewrite)
+    args = parser.parse_args(argv)
+    if not args.command:
+        parser.error("choose a benchmark")
+    sys.exit(args.func(args))
+
+
+if __name__ == '__main__':
+    main()
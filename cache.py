@@ -0,0 +1,121 @@
+import os
+import io
+import json
+import time
+import hashlib
+import tempfile
+from pathlib import Path
+
+
+def digest(*parts):
+    # Hash a sequence of strings/bytes into a hex key
+    h = hashlib.sha1()
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = str(part).encode('utf-8')
+        h.update(str(len(part)).encode('ascii') + b':')
+        h.update(part)
+    return h.hexdigest()
+
+def file_digest(path):
+    # Hash the contents of a file, or None if it can't be read
+    h = hashlib.sha1()
+    try:
+        with io.open(str(path), 'rb') as f:
+            for block in iter(lambda: f.read(1 << 16), b''):
+                h.update(block)
+    except (IOError, OSError):
+        return None
+    return h.hexdigest()
+
+
+# A directory of files named by key, evicting least recently used ones when it grows above `max_size` bytes
+class Cache(object):
+    # Seconds after which the size is measured again, to account for what other processes have written
+    scan_interval = 60
+
+    def __init__(self, path, max_size=512 * 1024 * 1024):
+        self.path = Path(path)
+        self.max_size = max_size
+        # Estimate of the total size: measured by `evict` (which has to go through the whole directory),
+        # then kept up to date with what this object writes
+        self.size = None
+        self.scanned = 0
+
+    def _file(self, key):
+        return self.path/key[:2]/key
+
+    def get(self, key):
+        # Return the stored bytes, or None on a miss
+        path = self._file(key)
+        try:
+            with io.open(str(path), 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            return None
+        try:
+            # Mark as recently used
+            os.utime(str(path), None)
+        except OSError:
+            pass
+        return data
+
+    def put(self, key, data):
+        path = self._file(key)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            try:
+                replaced = os.stat(str(path)).st_size
+            except OSError:
+                replaced = 0
+            # Write to a temporary file and move it into place, so concurrent readers never see partial data
+            fd, tmp = tempfile.mkstemp(dir=str(path.parent), prefix='.tmp')
+            with io.open(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, str(path))
+        except (IOError, OSError):
+            return
+        if self.size is not None and time.time() - self.scanned < self.scan_interval:
+            self.size += len(data) - replaced
+            if self.size <= self.max_size:
+                return
+        self.evict()
+
+    def get_json(self, key):
+        data = self.get(key)
+        if data is not None:
+            try:
+                return json.loads(data.decode('utf-8'))
+            except ValueError:
+                pass
+
+    def put_json(self, key, value):
+        self.put(key, json.dumps(value).encode('utf-8'))
+
+    def evict(self):
+        # Delete least recently used entries until the cache takes at most 90% of `max_size`
+        entries = []
+        total = 0
+        for dirpath, dirnames, filenames in os.walk(str(self.path)):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        self.scanned = time.time()
+        self.size = total
+        if total <= self.max_size:
+            return
+        entries.sort()
+        for mtime, size, path in entries:
+            if total <= self.max_size * 0.9:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+        self.size = total
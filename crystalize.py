@@ -2,435 +2,1464 @@
 
 import sys
 import os
+import io
 import re
+import glob
 import textwrap
 import collections
 import subprocess
+import argparse
+import traceback
+import tempfile
+import shutil
 import ast
+import time
+import json
+import functools
+import stat
+import signal
+import threading
 from pathlib import Path
 
 from util import *
+from cache import Cache, digest, file_digest
+from source import rewrite
+from macros import Macros
+from index import SymbolIndex, matches, reachable
+import abi
 
 import pycparser
 
-# Generate lextab, yacctab
-pycparser.CParser().parse('', '')
-try:
-    for f in ['lextab.py', 'yacctab.py']:
-        (here/f).rename(here/'pycparser'/'pycparser'/f)
-except Exception as e: pass
+# Convenience import to get all the node classes in the namespace
+from pycparser.c_ast import *
+
+
+fake_headers_path = here/'pycparser'/'utils'/'fake_libc_include'
+
+# `lib ...`
+lib_name = 'Lib'
 
 
+# The `rename_` functions accept names that are present in C and return the names that will be used in Crystal code
+
+# User-supplied mapping tables, see `load_mapping`
+type_mapping = {}
+name_mapping = {}
+
+# The `rename_` functions are called for every occurrence of a name, so their results are cached
+# Anything that changes what they return (`load_mapping`, plugins) must call `clear_name_caches`
+name_cache_size = 1 << 16
+
+# Used for variables, arguments, members.
+@functools.lru_cache(maxsize=name_cache_size)
+def rename_identifier(name):
+    return name_mapping.get(name) or unkeyword(to_snake(name))
+
+# Used for constants
+@functools.lru_cache(maxsize=name_cache_size)
+def rename_const(name):
+    return name_mapping.get(name) or unkeyword(to_snake_upper(name))
+
+# Used for functions
+@functools.lru_cache(maxsize=name_cache_size)
+def rename_func(name):
+    return name_mapping.get(name) or rename_identifier(name)
+
+# C types that have an analog in Crystal: regex that must match the whole name, and the Crystal type
+# (or a function of the match that returns it); the first one that matches is used
+native_types = [
+    (r'_*([Uu]?)[Ii]nt([1-9][0-9]*).*', lambda m: m.group(1).upper() + 'Int' + m.group(2)), # [U]IntXX
+    (r'_*[Ff]loat([1-9][0-9]*).*', lambda m: 'Float' + m.group(1)), # FloatXX
+    ('signed char', 'LibC::SChar'),
+    ('(unsigned )?char', 'LibC::Char'),
+    ('(signed )?short( int)?', 'LibC::Short'),
+    ('unsigned short( int)?', 'LibC::UShort'),
+    ('(signed )?int', 'LibC::Int'),
+    ('unsigned( int)?', 'LibC::UInt'),
+    ('(signed )?long( int)?', 'LibC::Long'),
+    ('unsigned long( int)?', 'LibC::ULong'),
+    ('(signed )?long long( int)?', 'LibC::LongLong'),
+    ('unsigned long long( int)?', 'LibC::ULongLong'),
+    ('float', 'LibC::Float'),
+    ('(long )?double', 'LibC::Double'),
+    ('size_t|uintptr_t', 'LibC::SizeT'),
+    ('ptrdiff_t|offset_t', 'LibC::PtrDiffT'),
+]
+
+_native_pattern = None
+
+def native_pattern():
+    # All of `native_types` in one regex, each in a named group, so a name is checked against them in one pass
+    global _native_pattern
+    if _native_pattern is None:
+        _native_pattern = re.compile('|'.join(
+            '(?P<native{}>(?:{})\\Z)'.format(i, match) for i, (match, repl) in enumerate(native_types)
+        ))
+    return _native_pattern
+
+# Detects native types and returns their analog in Crystal, or None if it is not a native type
+@functools.lru_cache(maxsize=name_cache_size)
+def native_type(name):
+    m = native_pattern().match(name)
+    if m:
+        # The named group is the outermost one, so it's the last to be closed
+        match, repl = native_types[int(m.lastgroup[len('native'):])]
+        if isinstance(repl, str):
+            return repl
+        else:
+            # Groups are numbered differently in the combined regex
+            return repl(re.match('(?:{})\\Z'.format(match), name))
+
+@functools.lru_cache(maxsize=name_cache_size)
+def rename_type(name, lib=None):
+    return type_mapping.get(name) or unkeyword(native_type(name) or to_capitals(name))
 
-# Path to the header file is the first command line argument
-header = Path(sys.argv[1])
-try:
-    # Include path is the second command line argument
-    root = Path(sys.argv[2])
-except IndexError:
-    # Or detect it automatically by searching upwards for a directory named 'include'
+def clear_name_caches():
+    global _native_pattern
+    _native_pattern = None
+    for func in [rename_identifier, rename_const, rename_func, native_type, rename_type]:
+        # Plugins may have replaced them with uncached functions
+        if hasattr(func, 'cache_clear'):
+            func.cache_clear()
+
+
+_loaded_mapping = None
+
+def load_mapping(path):
+    # Read mapping tables from a JSON file: {"types": {"C type": "CrystalType", ...}, "names": {"c_name": "crystal_name", ...},
+    # "native_types": [["regex", "CrystalType"], ...]}, all optional
+    # "types" and "names" replace what the `rename_` functions would return for exactly those C names;
+    # "native_types" are tried before the built-in `native_types`, and the type may refer to groups: "Int\\1"
+    global _loaded_mapping, _config_digest
+    if path is None:
+        return
+    path = str(Path(path).resolve())
+    with io.open(path, encoding='utf-8') as f:
+        text = f.read()
+    if _loaded_mapping is not None:
+        if _loaded_mapping[0] == path and _loaded_mapping[1] == digest(text):
+            return
+        raise ValueError("Another mapping file is already loaded: {}".format(_loaded_mapping[0]))
+    mapping = json.loads(text)
+    type_mapping.update(mapping.get('types', {}))
+    name_mapping.update(mapping.get('names', {}))
+    native_types[:0] = [
+        (match, (lambda repl: lambda m: m.expand(repl))(repl))
+        for match, repl in mapping.get('native_types', [])
+    ]
+    _loaded_mapping = (path, digest(text))
+    clear_name_caches()
+    # The output may change
+    _config_digest = None
+
+
+# The files of this program: this script and every module that the translation uses
+def program_files():
+    return [Path(__file__).resolve()] + [here/name for name in ['util.py', 'cache.py', 'source.py', 'macros.py', 'index.py', 'abi.py']]
+
+_config_digest = None
+
+def config_digest():
+    # Configuration is done by editing the code, so any change to it may change the output
+    global _config_digest
+    if _config_digest is None:
+        _config_digest = digest(
+            *[file_digest(path) for path in program_files()] +
+            [_loaded_mapping and _loaded_mapping[1]] + sorted(_loaded_plugins.values())
+        )
+    return _config_digest
+
+
+def find_root(header):
+    # Detect the include path by searching upwards for a directory named 'include'
     root = header.parent
     if 'include' in root.parts:
         while root.name != 'include':
             root = root.parent
-header = header.relative_to(root)
+    return root
 
-os.chdir(str(root))
 
-
-fake_headers_path = here/'pycparser'/'utils'/'fake_libc_include'
-if not fake_headers_path.is_dir():
-    err("Missing {}. This will cause problems.".format(fake_headers_path))
-
-err("================ Preprocessing =================")
-# Call GCC preprocessor
-proc = subprocess.Popen(['gcc', '-E',
-    '-undef',    # Do not predefine any system-specific or GCC-specific macros
-    '-dD',       # Dump all macro definitions, at the end of preprocessing, in addition to normal output
-    '-nostdinc', # Do not search the standard system directories for header files
-    '-I{}'.format(fake_headers_path), # Add pycparser's fake headers
-    '-I{}'.format(root),
-    str(header)
-], stdout=subprocess.PIPE, universal_newlines=True)
-src = proc.communicate()[0] # Get stdout
-
-
-# Hack to change all defines into fake constants, so they can be parsed later by pycparser
-# First we need a fake type to distinguish them
-src = '''
-typedef int _DEFINE;
-''' + src
-# Replace macros without arguments with consts
-src = re.sub(
-    r'^[ \t]*#define +([a-zA-Z_][_a-zA-Z_0-9]*) +(.+)$',
-    lambda m: 'const _DEFINE {} = "{}";'.format(m.group(1), m.group(2).replace('\\', '\\\\').replace('"', '\\"')),
-    src, flags=re.MULTILINE
-)
-# Discard the rest
-src = re.sub(r'^[ \t]*#(define|undef).*$', r'', src, flags=re.MULTILINE)
-
-# Discard #if...
-lines = []
-writing = True
-for line in src.splitlines():
-    if re.search(r'^[ \t]*#if(n)?.*(!)?', line):
-        writing = bool(m.group(1) or m.group(2))
-        lines.append('')
-    elif re.search(r'^[ \t]*#el', line):
-        writing = not writing
-        lines.append('')
-    elif re.search(r'^[ \t]*#end', line):
-        writing = True
-        lines.append('')
+def gcc_command(header, root):
+    # `header` can also be a list of headers, which are then included one after another into an empty file
+    if isinstance(header, list):
+        inputs = [arg for path in header for arg in ['-include', str(path)]] + ['-']
     else:
-        lines.append(line if writing else '')
-src = '\n'.join(lines)
+        inputs = [str(header)]
+    return ['gcc', '-E',
+        '-undef',    # Do not predefine any system-specific or GCC-specific macros
+        '-dD',       # Dump all macro definitions, at the end of preprocessing, in addition to normal output
+        '-nostdinc', # Do not search the standard system directories for header files
+        '-I{}'.format(fake_headers_path), # Add pycparser's fake headers
+        '-I{}'.format(root),
+    ] + inputs
 
-# Discard attributes
-src = re.sub(r'__attribute__[ \t]*\(\(.+\)\)', '', src)
+def run_gcc(command, deps=None):
+    # Call GCC preprocessor, yielding lines of its output as soon as they are produced
+    # The files it read are appended to the list `deps`
+    # Raises `CalledProcessError` after the last line if it failed (its messages go to stderr)
+    with tempfile.NamedTemporaryFile('r', suffix='.d') as depfile:
+        proc = subprocess.Popen(command + ['-MD', '-MF', depfile.name],
+            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, universal_newlines=True)
+        with proc.stdout:
+            for line in proc.stdout:
+                yield line
+        if proc.wait():
+            raise subprocess.CalledProcessError(proc.returncode, command)
+        if deps is not None:
+            deps.extend(parse_depfile(depfile.read()))
 
-# Uncomment to print the code that will be passed to pycparser
-#err(src)
+def preprocess(header, root, cache=None, deps=None):
+    # Returns an iterable of lines of preprocessed source
+    # The files it was produced from are appended to the list `deps`
+    command = gcc_command(header, root)
+    if not cache:
+        return run_gcc(command, deps)
+    return _preprocess_cached(command, cache, deps)
 
+def _preprocess_cached(command, cache, all_deps=None):
+    # The cached output is keyed by the command line and the contents of every file it was produced from.
+    # The list of those files comes from the previous run, stored under a key of just the command line.
+    def deps_key(deps):
+        return digest('preprocessed', *command + ['{}={}'.format(dep, file_digest(dep)) for dep in deps])
 
-err("=================== Parsing ====================")
-c_ast = parse_c(src)
+    manifest_key = digest('preprocess-deps', *command)
+    deps = cache.get_json(manifest_key)
+    if deps:
+        src = cache.get(deps_key(deps))
+        if src is not None:
+            if all_deps is not None:
+                all_deps.extend(deps)
+            for line in io.StringIO(src.decode('utf-8')):
+                yield line
+            return
 
-# Uncomment to print the abstract syntax tree produced by pycparser
-#err(debug_ast(c_ast, False))
+    deps = []
+    lines = []
+    for line in run_gcc(command, deps):
+        lines.append(line)
+        yield line
+    # Only reached if gcc succeeded (otherwise `run_gcc` raises), so a failure is reported again on the next run
+    cache.put(deps_key(deps), ''.join(lines).encode('utf-8'))
+    cache.put_json(manifest_key, deps)
+    if all_deps is not None:
+        all_deps.extend(deps)
 
 
+# Storage class for a function argument, struct member, etc
+class Item(collections.namedtuple('Item', 'name type')):
+    def __str__(self):
+        if self.name:
+            return '{} : {}'.format(self.name, self.type)
+        else:
+            return self.type
 
-# Convenience import to get all the node classes in the namespace
-from pycparser.c_ast import *
 
-err("================= Transforming =================")
+# Writes the generated code to a file as soon as each piece of it is ready
+# Code that goes after the lib statement is held in a temporary file (in memory while it's small) until the lib is closed
+# A piece of code that is the same as one written before is left out: the same declaration can be in several headers,
+# such as a forward declaration of a struct, but Crystal doesn't accept a constant etc. defined twice
+class LibWriter(object):
+    def __init__(self, file):
+        self.file = file
+        self.lib_count = 0
+        self.code = tempfile.SpooledTemporaryFile(max_size=1 << 20, mode='w+')
+        self.code_count = 0
+        self.file.write('lib {}\n'.format(lib_name))
+        # Digests of the pieces of code written so far, and the number of those left out
+        self.written = set()
+        self.duplicates = 0
 
-# Accumulate code that will be inside the lib statement...
-lib_code = []
-# and after it
-code = []
+    def is_duplicate(self, text):
+        key = digest(text)
+        if key in self.written:
+            self.duplicates += 1
+            return True
+        self.written.add(key)
+        return False
 
-# `lib ...`
-lib_name = 'Lib'
+    # `group` is the file the code came from, used by `GroupedLibWriter`
+    def write_lib(self, text, group=None):
+        if self.is_duplicate(text):
+            return
+        self._write_lib(text)
 
+    def _write_lib(self, text):
+        if self.lib_count:
+            self.file.write('  \n')
+        self.file.write(indent(text, '  ') + '\n')
+        self.file.flush()
+        self.lib_count += 1
 
-# The `rename_` functions accept names that are present in C and return the names that will be used in Crystal code
+    def write_code(self, text):
+        if self.is_duplicate(text):
+            return
+        if self.code_count:
+            self.code.write('\n')
+        self.code.write(text + '\n')
+        self.code_count += 1
 
-# Used for variables, arguments, members.
-def rename_identifier(name):
-    return unkeyword(to_snake(name))
+    def close(self):
+        if not self.lib_count:
+            self.file.write('\n')
+        self.file.write('end\n')
+        if self.code_count:
+            self.file.write('\n')
+            self.code.seek(0)
+            shutil.copyfileobj(self.code, self.file)
+        self.code.close()
+        self.file.flush()
 
-# Used for constants
-def rename_const(name):
-    return unkeyword(to_snake_upper(name))
 
-# Used for functions
-def rename_func(name):
-    return rename_identifier(name)
+# A `LibWriter` that groups the code in the lib by the file that it came from, with a comment naming the file before each group
+# The groups are in the order in which their files first appear; `root` is the include path that the names are relative to
+class GroupedLibWriter(LibWriter):
+    def __init__(self, file, root):
+        LibWriter.__init__(self, file)
+        self.root = Path(root)
+        self.groups = collections.OrderedDict()
 
-# Detects native types and returns their analog in Crystal, or None if it is not a native type
-def native_type(name):
-    for match, repl in {
-        r'_*([Uu]?)[Ii]nt([1-9][0-9]*).*': lambda m: m.group(1).upper() + 'Int' + m.group(2), # [U]IntXX
-        r'_*[Ff]loat([1-9][0-9]*).*': lambda m: 'Float' + m.group(1), # FloatXX
-        'signed char': 'LibC::SChar',
-        '(unsigned )?char': 'LibC::Char',
-        '(signed )?short( int)?': 'LibC::Short',
-        'unsigned short( int)?': 'LibC::UShort',
-        '(signed )?int': 'LibC::Int',
-        'unsigned( int)?': 'LibC::UInt',
-        '(signed )?long( int)?': 'LibC::Long',
-        'unsigned long( int)?': 'LibC::ULong',
-        '(signed )?long long( int)?': 'LibC::LongLong',
-        'unsigned long long( int)?': 'LibC::ULongLong',
-        'float': 'LibC::Float',
-        '(long )?double': 'LibC::Double',
-        'size_t|uintptr_t': 'LibC::SizeT',
-        'ptrdiff_t|offset_t': 'LibC::PtrDiffT',
-    }.items():
+    def write_lib(self, text, group=None):
+        if not self.is_duplicate(text):
+            self.groups.setdefault(group, []).append(text)
+
+    def close(self):
+        for group, texts in self.groups.items():
+            for i, text in enumerate(texts):
+                if i == 0 and group:
+                    try:
+                        name = Path(group).relative_to(self.root)
+                    except ValueError:
+                        name = group
+                    text = '# {}\n{}'.format(name, text)
+                self._write_lib(text)
+        LibWriter.close(self)
+
+
+# Functions that the `Translator` dispatches to by the class of an AST node.
+# More can be added (or these replaced) by plugins, see `load_plugins`.
+top_handlers = {}
+type_handlers = {}
+
+def is_define(top):
+    # A constant made from a macro, see `source.rewrite`
+    return isinstance(top, Decl) and top.quals == ['const'] and isinstance(top.type, TypeDecl) \
+        and getattr(top.type.type, 'names', None) == ['_DEFINE']
+
+
+class TypeGraph(object):
+    # The struct types and typedefs among the top-level declarations, by Crystal names
+    # It's built before anything is translated, so what it tells doesn't depend on the order of declarations
+    def __init__(self, ext):
+        # Names of structs (including tags and typedefs of struct types), and those of them that have members
+        structs = set()
+        defined = set()
+        # What a typedef without any pointers etc. stands for: `typedef A B;` or `typedef struct A B;`
+        targets = {}
+        # The names that structs with members are created with, by their tags: `struct T {...}` is created as T,
+        # but `typedef struct T {...} U;` as U
+        self.struct_names = {}
+        for top in ext:
+            if isinstance(top, Decl) and isinstance(top.type, Struct) and top.type.name:
+                name = rename_type(top.type.name)
+                structs.add(name)
+                if top.type.decls:
+                    defined.add(name)
+                    self.struct_names[name] = name
+            elif isinstance(top, Typedef) and isinstance(top.type, TypeDecl):
+                name = rename_type(top.name)
+                inner = top.type.type
+                if isinstance(inner, IdentifierType):
+                    targets[name] = rename_type(' '.join(inner.names))
+                    continue
+                if not isinstance(inner, Struct):
+                    continue
+                structs.add(name)
+                tag = inner.name and rename_type(inner.name)
+                if tag:
+                    structs.add(tag)
+                if inner.decls:
+                    defined.add(name)
+                    if tag:
+                        defined.add(tag)
+                        self.struct_names.setdefault(tag, name)
+                elif tag:
+                    targets[name] = tag
+
+        # Struct typedefs without members will be created as Void*, and so will typedefs that lead to them
+        self.pointer_types = {}
+        for name in structs | set(targets):
+            if name in self.pointer_types:
+                continue
+            # Follow the chain of typedefs, then give the answer to all of them at once
+            chain = []
+            while name not in self.pointer_types and name not in chain:
+                chain.append(name)
+                if name not in targets:
+                    break
+                name = targets[name]
+            result = self.pointer_types.get(name, name in structs and name not in defined)
+            for name in chain:
+                self.pointer_types[name] = result
+
+    def is_pointer_type(self, type):
+        # True or False for the names of structs and typedefs, None for other types
+        return self.pointer_types.get(type)
+
+    def struct_name(self, tag):
+        # The name that a struct with members is created with, or None
+        return self.struct_names.get(tag)
+
+
+def handles_top(*keys):
+    # Register a function(translator, top) that translates a top-level declaration and returns its kind
+    # Keys are (class of the declaration, class of the type it declares); the latter can be None to match any type.
+    # For typedefs of a type declaration, the class of the type inside it is used (`typedef struct {...} T` is (Typedef, Struct))
+    def decorator(func):
+        for key in keys:
+            top_handlers[key] = func
+        return func
+    return decorator
+
+def handles_type(*classes):
+    # Register a function(translator, type) that turns a type's AST of one of these classes into a Crystal type string
+    def decorator(func):
+        for cls in classes:
+            type_handlers[cls] = func
+        return func
+    return decorator
+
+
+# Turns the AST of one translation unit into Crystal code, passing it to a `LibWriter`
+class Translator(object):
+    # `memo` maps hashes of top-level declarations to what was produced from them in an earlier run (see `translate_cached`)
+    # `bodies` has the source of function bodies that were left out of the AST (see `source.rewrite`)
+    # `macros` is a `Macros` that gives values of defines
+    # `only` are glob patterns; if given, just the declarations with matching names are written
+    # `roots` are glob patterns; if given, just the declarations with matching names and those they need are written
+    # `record` makes the translator keep every declaration's code in `symbols`, for a `SymbolIndex`
+    def __init__(self, c_ast, writer, memo=None, stats=None, bodies=None, macros=None, only=None, roots=None, record=False):
+        self.c_ast = c_ast
+        self.bodies = bodies
+        self.macros = macros
+        # Ids of defines of macros that are defined again later; a lib can't have a constant twice,
+        # so there is one for each macro, with its final definition (which is what C code sees after the header)
+        self.redefined = set()
+        last_defines = {}
+        for top in c_ast.ext:
+            if is_define(top):
+                if top.name in last_defines:
+                    self.redefined.add(id(last_defines[top.name]))
+                last_defines[top.name] = top
+        self.only = only
+        self.symbols = [] if record else None
+        # `symbol_keys` of top-level declarations, by id
+        self.keys = {}
+        # Ids of the declarations to write, if not all
+        self.selected = None
+        if roots is not None:
+            tops = [top for top in c_ast.ext if not (top.coord and internal(top.coord.file))]
+            graph = [dict(zip(['declares', 'references'], self.symbol_keys(top)), name=top_name(top)) for top in tops]
+            self.selected = {id(tops[i]) for i in reachable(graph, roots)}
+        self.writer = writer
+        self.stats = stats or Stats()
+        self.memo = memo
+        # Entries of `memo` that were used or created in this run
+        self.new_memo = {}
+        self.reused = self.rebuilt = 0
+        # Dependencies of the declaration being translated on the translator's state
+        self.recording = None
+        # Accumulate code of the current declaration that will be inside the lib statement...
+        self.lib_code = []
+        # and after it
+        self.code = []
+        # Results of `make_type` for the current declaration, by id of the node
+        self.type_memo = {}
+
+        # Counter used to name anonymous structs
+        self.anonymous_counter = 0
+
+        # Struct typedefs without members will be created as Void*.
+        # They can only be used through a pointer, so the pointer will be included in a type and excluded whenever it's used
+        # However, a forward declaration doesn't mean it will remain without a definition,
+        # so this is decided by a preliminary pass over all the declarations
+        self.types = TypeGraph(c_ast.ext)
+        # The ones that were created
+        self.pointer_types = set()
+
+        # What the ABI verification needs to know about the generated types, see `abi.CrystalLayouts`
+        self.records = collections.OrderedDict()
+        self.aliases = {}
+        self.enums = {}
+        # How the structs and unions in `records` are spelled in C, for those that can be
+        self.c_types = collections.OrderedDict()
+
+    def symbol_keys(self, top):
         try:
-            m = re.fullmatch(match, name)
-        except AttributeError:
-            m = re.search('^(?:'+match+')$', name)
-        if m:
-            if isinstance(repl, str):
-                return repl
-            else:
-                return repl(m)
+            return self.keys[id(top)]
+        except KeyError:
+            result = self.keys[id(top)] = symbol_keys(top)
+            return result
+
+    def anon(self):
+        if self.recording is not None and self.recording['anon_start'] is None:
+            self.recording['anon_start'] = self.anonymous_counter
+        self.anonymous_counter += 1
+        return self.anonymous_counter
+
+    def is_pointer_type(self, type):
+        return self.check('is_pointer_type', type)
+
+    def struct_name(self, tag):
+        return self.check('struct_name', tag)
+
+    def check(self, method, name):
+        # Look something up in `types`; the answer is recorded for `memo_valid`
+        result = getattr(self.types, method)(name)
+        if self.recording is not None:
+            self.recording['checks'].append([method, name, result])
+        return result
+
+    def add_pointer_type(self, type):
+        self.pointer_types.add(type)
+        if self.recording is not None:
+            self.recording['pointer_types'].append(type)
+
+    # `table` is the name of one of the dicts of types for the ABI verification
+    def add_layout(self, table, name, value):
+        getattr(self, table)[name] = value
+        if self.recording is not None:
+            self.recording['layouts'].append([table, name, value])
+
+    def add_record(self, kind, name, c_type, members):
+        # `members` are pairs of C declarations and the `Item`s made from them
+        self.add_layout('records', name, {'kind': kind, 'members': [
+            # Bit fields have no offset
+            [item.name, None if decl.bitsize else decl.name, item.type] for decl, item in members
+        ]})
+        if c_type:
+            self.add_layout('c_types', name, c_type)
+
+    # Recursively turn a type's AST into a Crystal type string
+    # This is used for "inline" types, such as variable's type or struct member's type, and not for top-level declarations.
+    def make_type(self, type):
+        # pycparser shares subtrees between declarators (`struct {...} a, b;`), so each node is handled once
+        try:
+            return self.type_memo[id(type)][1]
+        except KeyError:
+            pass
+        handler = type_handlers.get(type.__class__)
+        if handler:
+            result = handler(self, type)
+        else:
+            # Don't know what this is. Just paste the C code
+            result = generate_c(type)
+        # Keep the node too, so its id isn't reused
+        self.type_memo[id(type)] = (type, result)
+        return result
 
-def rename_type(name, lib=None):
-    return unkeyword(native_type(name) or to_capitals(name))
-
-# Counter used to name anonymous structs
-anonymous_counter = 0
-def anon():
-    global anonymous_counter
-    anonymous_counter += 1
-    return anonymous_counter
-
-# Recursively turn a type's AST into a Crystal type string
-# This is used for "inline" types, such as variable's type or struct member's type, and not for top-level declarations.
-def make_type(type):
     # If it's a pointer type
-    if isinstance(type, PtrDecl):
+    @handles_type(PtrDecl)
+    def make_pointer_type(self, type):
         # If it's a function pointer
         if isinstance(type.type, FuncDecl):
             # Handle the function declaration in another call
-            return make_type(type.type)
+            return self.make_type(type.type)
         # Make the rest of the type and add a star at the end, unless it's a Void*-type
-        result = make_type(type.type)
-        if not is_pointer_type(result) or isinstance(type.type, PtrDecl):
+        result = self.make_type(type.type)
+        if not self.is_pointer_type(result) or isinstance(type.type, PtrDecl):
             result += '*'
         return result
-    
+
     # If it's an array type
-    if isinstance(type, ArrayDecl):
+    @handles_type(ArrayDecl)
+    def make_array_type(self, type):
         # Make the rest of the type and add brackets at the end, with the value
         # The value is typically a number, but could be any C code
         # We just generate C and hope it will be valid Crystal code
         if type.dim:
-            return '{}[{}]'.format(make_type(type.type), generate_c(type.dim.value))
+            return '{}[{}]'.format(self.make_type(type.type), generate_c(type.dim.value))
         else:
             # Array without specified dimension
-            return '{}*'.format(make_type(type.type))
-    
+            return '{}*'.format(self.make_type(type.type))
+
     # If it's a function type
-    if isinstance(type, FuncDecl):
+    @handles_type(FuncDecl)
+    def make_func_type(self, type):
         func = type
-        func_type = make_type(func.type)
+        func_type = self.make_type(func.type)
         # Turn each argument AST into an name:type pair and get just the type
         # Caveats: func.args may be None; arg may be void due to simplistic parsing of function without arguments
-        func_args = make_args(func.args)
+        func_args = self.make_args(func.args)
         # Form a template (no parentheses needed for 1 arg, skip altogether for 0 args)
         fmt = ('({args}) -> {type}' if len(func_args) > 1 else '{args} -> {type}') if func_args else '-> {type}'
         # Fill the template with list of args and return type
         return fmt.format(args=', '.join(arg.type for arg in func_args), type=func_type)
-    
+
     # If it's a misc type declaration
-    if isinstance(type, TypeDecl):
+    @handles_type(TypeDecl)
+    def make_type_decl(self, type):
         # If it's a struct
         if isinstance(type.type, (Struct, Union)) and type.type.decls:
-            # This will be a struct inside a struct, typically anonymous
-            struct = type.type
-            # Get the struct's name or generate one
-            struct_name = struct.name or 'Anonymous{}'.format(anon())
-            output = []
-            output.append('{} {}'.format(
-                'struct' if isinstance(type.type, Struct) else 'union',
-                rename_type(struct_name)
-            ))
-            for decl in struct.decls:
-                member = make_member(decl)
-                output.append('  {} : {}'.format(member.name, member.type))
-            output.append('end')
-            # Immediately add the struct to the lib, and return just its name
-            # This unfolds nested structs
-            lib_code.append('\n'.join(output))
-            return rename_type(struct_name)
+            return self.make_type(type.type)
         # If it's just some normal type, which might consist of multiple components
         try:
             return rename_type(' '.join(type.type.names))
         except AttributeError:
             return rename_type(type.type.name)
-    
-    # Don't know what this is. Just paste the C code
-    return generate_c(type)
 
-# Storage class for a function argument, struct member, etc
-class Item(collections.namedtuple('Item', 'name type')):
-    def __str__(self):
-        if self.name:
-            return '{} : {}'.format(self.name, self.type)
+    # A struct inside a struct, typically anonymous
+    @handles_type(Struct, Union)
+    def make_struct_type(self, struct):
+        # Get the struct's name or generate one
+        struct_name = struct.name or 'Anonymous{}'.format(self.anon())
+        kind = 'struct' if isinstance(struct, Struct) else 'union'
+        output = []
+        output.append('{} {}'.format(kind, rename_type(struct_name)))
+        members = []
+        for decl in struct.decls:
+            member = self.make_member(decl)
+            members.append((decl, member))
+            output.append('  {} : {}'.format(member.name, member.type))
+        output.append('end')
+        self.add_record(kind, rename_type(struct_name), struct.name and '{} {}'.format(kind, struct.name), members)
+        # Immediately add the struct to the lib, and return just its name
+        # This unfolds nested structs
+        self.lib_code.append('\n'.join(output))
+        return rename_type(struct_name)
+
+    # Process function argument
+    def make_arg(self, arg):
+        if isinstance(arg, EllipsisParam):
+            return '...'
+        if isinstance(arg, Typename):
+            # Just a type, no name
+            try:
+                if arg.type.type.names == ['void']:
+                    return None
+            except AttributeError:
+                pass
+            return Item(name=None, type=self.make_type(arg.type))
+        return Item(
+            name=rename_identifier(arg.name) if arg.name else None,
+            type=self.make_type(arg.type)
+        )
+
+    def make_args(self, args):
+        if not args:
+            # f()
+            return []
+        # f(void) gives None
+        return [arg for arg in map(self.make_arg, args.params) if arg is not None]
+
+    # Process struct (etc.) member
+    def make_member(self, member):
+        return self.make_arg(member)
+
+    # Iterate over top-level declarations
+    def translate(self):
+        # Declarations seen so far, by where they are in the source. A header without an include guard
+        # can be included more than once, but its declarations must appear in the lib only once.
+        seen = set()
+        for top in self.c_ast.ext:
+            if top.coord and internal(top.coord.file):
+                # Not part of the lib
+                self.stats.count('internal_declarations')
+                continue
+            if id(top) in self.redefined:
+                self.stats.count('redefined_macros')
+                continue
+            if top.coord:
+                key = (top.coord.file, top.coord.line, type(top).__name__, top_name(top))
+                if key in seen:
+                    self.stats.count('duplicate_declarations')
+                    continue
+                seen.add(key)
+            start = time.perf_counter()
+            self.type_memo = {}
+            try:
+                if self.memo is None:
+                    kind = self.translate_top(top)
+                else:
+                    kind = self.translate_cached(top)
+            except Exception as e:
+                err(debug_ast(top))
+                err(debug_source_ast(top))
+                raise
+            name = top_name(top)
+            file = top.coord.file if top.coord else None
+            if self.symbols is not None:
+                declares, references = self.symbol_keys(top)
+                self.symbols.append(dict(
+                    name=name, kind=kind, file=file, line=top.coord.line if top.coord else None, hash=ast_digest(top),
+                    declares=declares, references=references, lib_code=list(self.lib_code), code=list(self.code)
+                ))
+            if self.only is not None and not matches(name, self.only) \
+                    or self.selected is not None and id(top) not in self.selected:
+                # Everything is translated anyway, because declarations affect the translation of later ones
+                self.lib_code = []
+                self.code = []
+            self.flush(file)
+            self.stats.declaration(kind, name, time.perf_counter() - start)
+
+    def flush(self, group=None):
+        for text in self.lib_code:
+            self.writer.write_lib(text, group)
+        for text in self.code:
+            self.writer.write_code(text)
+        self.lib_code = []
+        self.code = []
+
+    # Translate a declaration, or reuse the result from an earlier run if the declaration is unchanged.
+    # Besides the AST, the result depends only on the state of the translator that was looked at while producing it,
+    # so that is recorded too, and the stored result is reused only if the state is still the same.
+    def translate_cached(self, top):
+        key = digest(config_digest(), ast_digest(top), self.define_value(top))
+        entry = self.memo.get(key)
+        if entry and self.memo_valid(entry):
+            self.lib_code.extend(entry['lib_code'])
+            self.code.extend(entry['code'])
+            self.pointer_types.update(entry['pointer_types'])
+            for table, name, value in entry['layouts']:
+                getattr(self, table)[name] = value
+            self.anonymous_counter += entry['anon_count']
+            self.reused += 1
+            kind = entry['kind']
         else:
-            return self.type
-# Process function argument
-def make_arg(arg):
-    if isinstance(arg, EllipsisParam):
-        return '...'
-    if isinstance(arg, Typename):
-        # Just a type, no name
-        try:
-            if arg.type.type.names == ['void']:
-                return None
-        except AttributeError:
-            pass
-        return Item(name=None, type=make_type(arg.type))
-    return Item(
-        name=rename_identifier(arg.name) if arg.name else None,
-        type=make_type(arg.type)
-    )
-def make_args(args):
-    if not args:
-        # f()
-        return []
-    result = [make_arg(arg) for arg in args.params if make_arg(arg)]
-    if result == [None]:
-        # f(void)
-        return []
-    return result
-    
-# Process struct (etc.) member
-def make_member(member):
-    return make_arg(member)
-
-# Struct typedefs without members will be created as Void*.
-# They can only be used through a pointer, so the pointer will be included in a type and excluded whenever it's used
-pointer_types = set()
-# However, a forward declaration doesn't mean it will remain without a definition
-# So we do a preliminary pass to find all structs with members; they definitely can't be pointer types
-non_pointer_types = {
-    rename_type(top.type.name)
-    for top in c_ast.ext
-    if isinstance(top, Decl) and isinstance(top.type, Struct) and top.type.decls
-}
-
-def is_pointer_type(type):
-    if type in non_pointer_types:
-        return False
-    if type in pointer_types:
-        return True
+            anon_start = self.anonymous_counter
+            self.recording = {'checks': [], 'pointer_types': [], 'layouts': [], 'anon_start': None}
+            try:
+                kind = self.translate_top(top)
+            finally:
+                entry, self.recording = self.recording, None
+            entry['kind'] = kind
+            entry['lib_code'] = list(self.lib_code)
+            entry['code'] = list(self.code)
+            entry['anon_count'] = self.anonymous_counter - anon_start
+            self.rebuilt += 1
+        self.new_memo[key] = entry
+        return kind
 
-# Iterate over top-level declarations
-for top in c_ast.ext:
-    try:
-        # Store output code in a list
+    def memo_valid(self, entry):
+        if entry['anon_start'] is not None and entry['anon_start'] != self.anonymous_counter:
+            # Anonymous structs would be numbered differently
+            return False
+        return all(getattr(self.types, method)(name) == result for method, name, result in entry['checks'])
+
+    # Value of a define, which depends on other defines, or None
+    def define_value(self, top):
+        if self.macros and is_define(top):
+            return self.macros.crystal(top.name)
+
+    # Source of a function definition's body that was left out of the AST, or None
+    def body_source(self, top):
+        # The body was replaced with the key of its source (the AST still depends on the source this way)
+        items = top.body.block_items
+        if self.bodies and items and len(items) == 1 and isinstance(items[0], Constant) and items[0].type == 'string':
+            return self.bodies.get(items[0].value.strip('"'))
+
+    # Translate a top-level declaration and return its kind
+    def translate_top(self, top):
+        inner = getattr(top, 'type', None)
+        if isinstance(top, Typedef) and isinstance(inner, TypeDecl):
+            # typedef struct {
+            inner = inner.type
+        handler = top_handlers.get((type(top), type(inner))) or top_handlers.get((type(top), None))
+        if handler is None:
+            raise Exception("Unknown")
+        return handler(self, top)
+
+    # Function declaration
+    @handles_top((Decl, FuncDecl))
+    def translate_fun(self, top):
+        func = top.type
+        func_name = top.name
+        func_args = self.make_args(func.args)
+        func_type = self.make_type(func.type)
+
+        self.lib_code.append('fun {} = "{}"({}) : {}'.format(
+            rename_func(func_name), func_name,
+            ', '.join(str(arg) for arg in func_args),
+            func_type
+        ))
+        return 'fun'
+
+    # Function definition (with body)
+    @handles_top((FuncDef, None))
+    def translate_def(self, top):
+        decl, body = top.decl, top.body
+        func = decl.type
+        func_name = decl.name
+        func_args = self.make_args(func.args)
+        func_type = self.make_type(func.type)
+
+        cr_output = []
+        cr_output.append('def {}({}) : {}'.format(
+            rename_func(func_name),
+            ', '.join(str(arg) for arg in func_args),
+            func_type
+        ))
+        # Re-generate the function body C code (or take its source) and just plop it in there, commented out
+        src = self.body_source(top)
+        if src is None:
+            src = generate_c(body)
+        src = src.strip('\n')
+        if src.startswith('{') and src.endswith('}'):
+            src = textwrap.dedent(src[1:-1].strip('\n'))
+        src = re.sub(r'[ \t]*\n+', r'\n', src).rstrip()
+        cr_output.append(indent(src, '  # '))
+        cr_output.append('end')
+        self.code.append('\n'.join(cr_output))
+        return 'def'
+
+    # Struct
+    @handles_top((Decl, Struct), (Typedef, Struct))
+    def translate_struct(self, top):
         output = []
-        
-        if top.coord and internal(top.coord.file):
-            # Not part of the lib
-            continue
-        
-        # Function declaration
-        if isinstance(top, Decl) and isinstance(top.type, FuncDecl):
-            func = top.type
-            func_name = top.name
-            func_args = make_args(func.args)
-            func_type = make_type(func.type)
-            
-            output.append('fun {} = "{}"({}) : {}'.format(
-                rename_func(func_name), func_name,
-                ', '.join(str(arg) for arg in func_args),
-                func_type
-            ))
-        
-        # Function definition (with body)
-        elif isinstance(top, FuncDef):
-            decl, body = top.decl, top.body
-            func = decl.type
-            func_name = decl.name
-            func_args = make_args(func.args)
-            func_type = make_type(func.type)
-            
-            cr_output = []
-            cr_output.append('def {}({}) : {}'.format(
-                rename_func(func_name),
-                ', '.join(str(arg) for arg in func_args),
-                func_type
-            ))
-            # Re-generate the function body C code and just plop it in there, commented out
-            src = generate_c(body).strip('\n')
-            if src.startswith('{') and src.endswith('}'):
-                src = textwrap.dedent(src[1:-1].strip('\n'))
-            src = re.sub(r'\n+', r'\n', src)
-            cr_output.append(indent(src, '  # '))
-            cr_output.append('end')
-            code.append('\n'.join(cr_output))
-        
-        # Struct
-        elif isinstance(top, Decl) and isinstance(top.type, Struct) or\
-          isinstance(top, Typedef) and isinstance(top.type.type, Struct):
-            if isinstance(top, Decl):
-                # struct T {
-                struct, struct_name = top.type, top.type.name
-            else:
-                # typedef struct {
-                struct, struct_name = top.type.type, top.name
-            if struct.decls:
-                output.append('struct {}'.format(rename_type(struct_name)))
-                for decl in struct.decls:
-                    member = make_member(decl)
-                    output.append('  {} : {}'.format(member.name, member.type))
-                output.append('end')
-            else:
-                # Empty struct or just a forward declaration
-                if is_pointer_type(rename_type(struct_name)) is not False:
-                    # Strictly False means there is a full declaration, so this is not needed
-                    output.append('type {} = Void*'.format(rename_type(struct_name)))
-                    pointer_types.add(rename_type(struct_name))
-        
-        # Enum
-        elif isinstance(top, Decl) and isinstance(top.type, Enum) or\
-          isinstance(top, Typedef) and isinstance(top.type.type, Enum):
-            if isinstance(top, Decl):
-                # enum T {
-                enum, enum_name = top.type, top.type.name
-            else:
-                # typedef enum {
-                enum, enum_name = top.type.type, top.name
-            if enum.values:
-                # Non-empty enum
-                if enum_name:
-                    output.append('enum {}'.format(rename_type(enum_name)))
-                    for item in enum.values.enumerators:
-                        if item.value:
-                            output.append('  {} = {}'.format(rename_const(item.name), generate_c(item.value)))
-                        else:
-                            output.append('  {}'.format(rename_const(item.name)))
-                    output.append('end')
-                else:
-                    # Anonymous enum; just output constants
-                    for item in enum.values.enumerators:
+        if isinstance(top, Decl):
+            # struct T {
+            struct, struct_name = top.type, top.type.name
+        else:
+            # typedef struct {
+            struct, struct_name = top.type.type, top.name
+        if struct.decls:
+            output.append('struct {}'.format(rename_type(struct_name)))
+            members = []
+            for decl in struct.decls:
+                member = self.make_member(decl)
+                members.append((decl, member))
+                output.append('  {} : {}'.format(member.name, member.type))
+            output.append('end')
+            self.add_record('struct', rename_type(struct_name), 'struct ' + struct_name if isinstance(top, Decl) else struct_name, members)
+        else:
+            # Empty struct or just a forward declaration
+            if self.is_pointer_type(rename_type(struct_name)) is not False:
+                # Strictly False means there is a full declaration, so this is not needed
+                output.append('type {} = Void*'.format(rename_type(struct_name)))
+                self.add_pointer_type(rename_type(struct_name))
+            elif isinstance(top, Typedef) and struct.name:
+                # typedef struct T U; where T has a full declaration, under its own name or another typedef's
+                target = self.struct_name(rename_type(struct.name))
+                if target and target != rename_type(struct_name):
+                    self.add_layout('aliases', rename_type(struct_name), target)
+                    output.append('alias {} = {}'.format(rename_type(struct_name), target))
+        if output:
+            self.lib_code.append('\n'.join(output))
+        return 'struct'
+
+    # Enum
+    @handles_top((Decl, Enum), (Typedef, Enum))
+    def translate_enum(self, top):
+        output = []
+        if isinstance(top, Decl):
+            # enum T {
+            enum, enum_name = top.type, top.type.name
+        else:
+            # typedef enum {
+            enum, enum_name = top.type.type, top.name
+        if enum.values:
+            # Non-empty enum
+            if enum_name:
+                self.add_layout('enums', rename_type(enum_name), True)
+                output.append('enum {}'.format(rename_type(enum_name)))
+                for item in enum.values.enumerators:
+                    if item.value:
                         output.append('  {} = {}'.format(rename_const(item.name), generate_c(item.value)))
-        
-        # Union
-        elif isinstance(top, Decl) and isinstance(top.type, Union) or\
-          isinstance(top, Typedef) and isinstance(top.type.type, Union):
-            if isinstance(top, Decl):
-                # union T{
-                union, union_name = top.type, top.type.name
-            else:
-                # typedef union {
-                union, union_name = top.type.type, top.name
-            if union.decls:
-                # Non-empty union
-                output.append('union {}'.format(rename_type(union_name)))
-                for decl in union.decls:
-                    member = make_member(decl)
-                    output.append('  {} : {}'.format(rename_identifier(member.name), member.type))
+                    else:
+                        output.append('  {}'.format(rename_const(item.name)))
                 output.append('end')
-        
-        # Typedef
-        elif isinstance(top, Typedef):
-            output.append('alias {} = {}'.format(rename_type(top.name), make_type(top.type)))
-        
+            else:
+                # Anonymous enum; just output constants
+                for item in enum.values.enumerators:
+                    output.append('  {} = {}'.format(rename_const(item.name), generate_c(item.value)))
+        if output:
+            self.lib_code.append('\n'.join(output))
+        return 'enum'
+
+    # Union
+    @handles_top((Decl, Union), (Typedef, Union))
+    def translate_union(self, top):
+        output = []
+        if isinstance(top, Decl):
+            # union T{
+            union, union_name = top.type, top.type.name
+        else:
+            # typedef union {
+            union, union_name = top.type.type, top.name
+        if union.decls:
+            # Non-empty union
+            output.append('union {}'.format(rename_type(union_name)))
+            members = []
+            for decl in union.decls:
+                member = self.make_member(decl)
+                members.append((decl, member))
+                output.append('  {} : {}'.format(rename_identifier(member.name), member.type))
+            output.append('end')
+            self.add_record('union', rename_type(union_name), 'union ' + union_name if isinstance(top, Decl) else union_name, members)
+            self.lib_code.append('\n'.join(output))
+        return 'union'
+
+    # Typedef
+    @handles_top((Typedef, None))
+    def translate_alias(self, top):
+        type = self.make_type(top.type)
+        self.add_layout('aliases', rename_type(top.name), type)
+        self.lib_code.append('alias {} = {}'.format(rename_type(top.name), type))
+        return 'alias'
+
+    # Const or global variable
+    @handles_top((Decl, None))
+    def translate_decl(self, top):
         # Const
-        elif isinstance(top, Decl) and top.quals == ['const']:
+        if top.quals == ['const']:
             val = ''
             if top.init:
                 val = top.init.value
                 if ' '.join(top.type.type.names) == '_DEFINE':
-                    val = ast.literal_eval(val)
-            output.append('{}{} = {}'.format('' if val else '#', rename_const(top.name), val))
-        
+                    value = self.define_value(top)
+                    if value is not None:
+                        self.stats.count('resolved_macros')
+                        val = value
+                    else:
+                        # Can't evaluate it, use the macro's code as is
+                        val = ast.literal_eval(val)
+            self.lib_code.append('{}{} = {}'.format('' if val else '#', rename_const(top.name), val))
+            return 'const'
+
         # Global variable
-        elif isinstance(top, Decl):
-            output.append('${} : {}'.format(rename_identifier(top.name), make_type(top.type)))
-        
+        self.lib_code.append('${} : {}'.format(rename_identifier(top.name), self.make_type(top.type)))
+        return 'var'
+
+
+_loaded_plugins = {}
+
+def load_plugins(paths):
+    # Run Python files that customize the translation without editing this script.
+    # They run in this module's namespace, so they can register handlers with `handles_top` and `handles_type`,
+    # or replace any of the `rename_` functions, `lib_name` etc.
+    global _config_digest
+    for path in paths:
+        path = str(Path(path).resolve())
+        if path in _loaded_plugins:
+            continue
+        with io.open(path, encoding='utf-8') as f:
+            code = f.read()
+        exec(compile(code, path, 'exec'), globals())
+        _loaded_plugins[path] = digest(code)
+        # The output may change
+        _config_digest = None
+        clear_name_caches()
+
+
+def counted(lines, stats, key):
+    # Pass lines through, adding up their size
+    for line in lines:
+        stats.count(key, len(line))
+        yield line
+
+
+def crystalize(header, root=None, cache=None, out=None, parse_jobs=None, keep_internal=False, stats=None, plugins=(),
+               raw_bodies=False, index=None, only=None, roots=None, recover=False, verify_abi=False, deps=None, mapping=None):
+    # Write Crystal code for one header file to `out` (stdout by default); `root` is the include path
+    # `header` can also be a list of headers, which are translated together into one lib (see `GroupedLibWriter`)
+    # `cache` is an optional `Cache` for reusing results of previous runs
+    # `parse_jobs` is the number of processes to parse in
+    # `keep_internal` passes declarations from internal files (see `internal`) to the parser
+    # `stats` is a `Stats` object that receives timings and counters
+    # `plugins` are paths of files to load with `load_plugins`
+    # `raw_bodies` keeps bodies of function definitions away from the parser; their source is used as is
+    # `index` is the path of a `SymbolIndex`; the code is taken from it if none of the files have changed
+    # `only` are glob patterns of names of the declarations to write (all by default)
+    # `roots` are glob patterns of names of declarations to write along with everything they need (see `index.reachable`)
+    # `recover` leaves out declarations that fail to parse, instead of stopping at the first one
+    # `verify_abi` compares the layouts of the generated structs and unions with the C compiler's (see `abi.verify`);
+    # mismatches are reported and counted as 'abi_mismatches' in `stats`
+    # `deps` is a list that receives the paths of the files the output was produced from (see `write_depfile`)
+    # `mapping` is the path of a JSON file with mapping tables, see `load_mapping`
+    load_mapping(mapping)
+    load_plugins(plugins)
+    if out is None:
+        out = sys.stdout
+    if stats is None:
+        stats = Stats()
+    umbrella = isinstance(header, (list, tuple))
+    if umbrella:
+        header = [Path(path).resolve() for path in header]
+    else:
+        header = Path(header).resolve()
+    if root is None:
+        root = find_root(header[0] if umbrella else header)
+    root = Path(root).resolve()
+
+    options = dict(cache=cache, parse_jobs=parse_jobs, keep_internal=keep_internal, raw_bodies=raw_bodies,
+                   only=only, roots=roots, recover=recover)
+    if index and not verify_abi:
+        index = SymbolIndex(index)
+        try:
+            unit = digest('unit', config_digest(), root, keep_internal, raw_bodies, recover, *header if umbrella else [header])
+            fresh = index.fresh(unit)
+            if fresh is not None:
+                if deps is not None:
+                    deps.extend(fresh)
+                err("Taking declarations from the index")
+                symbols = list(index.symbols(unit))
+                selected = reachable(symbols, roots) if roots is not None else None
+                symbols = [
+                    symbol for i, symbol in enumerate(symbols)
+                    if (selected is None or i in selected) and (only is None or matches(symbol['name'], only))
+                ]
+                stats.count('indexed_declarations', write_indexed(symbols, out, root, umbrella))
+                return
+            unit_deps = []
+            symbols = _crystalize(header, root, out, stats, deps=unit_deps, record=True, **options)
+            index.store(unit, unit_deps, symbols)
+            if deps is not None:
+                deps.extend(unit_deps)
+        finally:
+            index.close()
+    else:
+        _crystalize(header, root, out, stats, verify_abi=verify_abi, deps=deps, **options)
+
+def write_indexed(symbols, out, root, umbrella):
+    # Write declarations from a `SymbolIndex` and return their number
+    writer = GroupedLibWriter(out, root) if umbrella else LibWriter(out)
+    count = 0
+    for symbol in symbols:
+        for text in symbol['lib_code']:
+            writer.write_lib(text, symbol['file'])
+        for text in symbol['code']:
+            writer.write_code(text)
+        count += 1
+    writer.close()
+    return count
+
+def _crystalize(header, root, out, stats, cache=None, parse_jobs=None, keep_internal=False, raw_bodies=False,
+                only=None, roots=None, recover=False, verify_abi=False, deps=None, record=False):
+    # The work of `crystalize`, with `header` and `root` resolved; options are the same
+    # Returns the translated declarations if `record` is true (see `Translator`)
+    umbrella = isinstance(header, list)
+    if not fake_headers_path.is_dir():
+        err("Missing {}. This will cause problems.".format(fake_headers_path))
+
+    err("================ Preprocessing =================")
+    with stats.phase('preprocess'):
+        # Declarations from internal files are not translated, so they don't need to be parsed either
+        bodies = {} if raw_bodies else None
+        macros = Macros()
+        src = rewrite(counted(preprocess(header, root, cache, deps), stats, 'preprocessed_bytes'), None if keep_internal else internal,
+                      bodies, macros)
+    stats.count('parser_input_bytes', len(src))
+    if raw_bodies:
+        stats.count('raw_bodies', len(bodies))
+
+    # Uncomment to print the code that will be passed to pycparser
+    #err(src)
+
+    err("=================== Parsing ====================")
+    errors = [] if recover else None
+    with stats.phase('parse'):
+        try:
+            # Without internal declarations, a failure is first retried with them (below),
+            # which reports the error if it's still there
+            c_ast = parse_c(src, cache, parse_jobs, errors if keep_internal else None, quiet=not keep_internal)
+        except pycparser.plyparser.ParseError:
+            if keep_internal:
+                raise
+            # Maybe the library's code needs more from the internal files than typedef names
+            err("Parsing again with declarations from internal files")
+            if raw_bodies:
+                bodies.clear()
+            macros = Macros()
+            src = rewrite(preprocess(header, root, cache, deps), bodies=bodies, macros=macros)
+            c_ast = parse_c(src, cache, parse_jobs, errors)
+    stats.count('top_level_nodes', len(c_ast.ext))
+    if errors:
+        # Report all of them at once
+        stats.count('parse_errors', len(errors))
+        err("Left out {} declarations that failed to parse:".format(len(errors)))
+        for message in errors:
+            err(indent(message, '  '))
+            context = debug_parse_error(message)
+            if context:
+                err(indent(context, '    '))
+    stats.count('macros', len(macros.definitions))
+
+    # Uncomment to print the abstract syntax tree produced by pycparser
+    #err(debug_ast(c_ast, False))
+
+    err("================= Transforming =================")
+    with stats.phase('transform'):
+        memo = memo_key = None
+        if cache:
+            memo_key = digest('declarations', *header) if umbrella else digest('declarations', header)
+            memo = cache.get_json(memo_key) or {}
+        writer = GroupedLibWriter(out, root) if umbrella else LibWriter(out)
+        translator = Translator(c_ast, writer, memo, stats, bodies, macros, only, roots, record)
+        translator.translate()
+        writer.close()
+        stats.count('duplicate_code', writer.duplicates)
+        if cache:
+            cache.put_json(memo_key, translator.new_memo)
+            stats.count('reused_declarations', translator.reused)
+            stats.count('rebuilt_declarations', translator.rebuilt)
+            err("Reused {} declarations, rebuilt {}".format(translator.reused, translator.rebuilt))
+
+    if verify_abi:
+        err("================ Verifying ABI =================")
+        with stats.phase('verify_abi'):
+            layouts = abi.CrystalLayouts(translator.records, translator.aliases, translator.enums, translator.pointer_types)
+            try:
+                mismatches, checked = abi.verify(header if umbrella else [header], root, layouts, translator.c_types)
+            except subprocess.CalledProcessError as e:
+                err("Couldn't compile the layout probe:\n{}".format(e.stderr or ''))
+                raise
+        stats.count('abi_checked', checked)
+        stats.count('abi_mismatches', len(mismatches))
+        for mismatch in mismatches:
+            err("Layout mismatch: {}".format(mismatch))
+        err("Checked {} structs and unions, {} differ".format(checked, len(mismatches)))
+    return translator.symbols
+
+
+class OutputFile(object):
+    # Context manager that gives a file to write the contents of `path` to
+    # It is written next to `path` and replaces it only when done, and only if the contents differ,
+    # so `path` is never left half-written and build systems don't see a change when there isn't one
+    # `changed` tells if `path` was replaced
+    def __init__(self, path):
+        self.path = Path(path)
+        self.changed = False
+
+    def __enter__(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.file = tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=str(self.path.parent),
+                                                prefix='.' + self.path.name, suffix='.tmp', delete=False)
+        return self.file
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.file.close()
+        tmp = self.file.name
+        if exc_type is None and not (self.path.is_file() and file_digest(tmp) == file_digest(self.path)):
+            # Temporary files are private, the output gets the usual permissions
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp, 0o666 & ~umask)
+            os.replace(tmp, str(self.path))
+            self.changed = True
         else:
-            raise Exception("Unknown")
-        
-        if output:
-            lib_code.append('\n'.join(output))
-    except Exception as e:
-        err(debug_ast(top))
-        err(debug_source_ast(top))
-        raise
-
-
-print('lib {}'.format(lib_name))
-print(indent('\n\n'.join(lib_code), '  '))
-print('end')
-if code:
-    print('')
-    print('\n\n'.join(code))
+            os.unlink(tmp)
+
+
+def write_depfile(path, target, deps):
+    # Write a Make-style dependency file (also understood by Ninja) saying that `target` depends on `deps`,
+    # the files the translation read, and on the files of this program and plugins, which affect the output too
+    def escape(path):
+        # The way gcc escapes them
+        return str(path).replace(' ', '\\ ').replace('#', '\\#').replace('$', '$$')
+    files = list(deps) + program_files() + sorted(_loaded_plugins)
+    if _loaded_mapping:
+        files.append(_loaded_mapping[0])
+    files = list(collections.OrderedDict.fromkeys(str(path) for path in files))
+    with OutputFile(path) as f:
+        f.write('{}: \\\n'.format(escape(target)))
+        f.write(' \\\n'.join('  ' + escape(path) for path in files) + '\n')
+
+
+def crystalize_file(header, root, output, depfile=None, **options):
+    # Batch worker: translate one header into the file `output` (see `OutputFile`); `options` are passed to `crystalize`
+    # With `depfile`, the files it was produced from are written there (see `write_depfile`)
+    # Returns an error message (None on success) and the stats of the run
+    stats = Stats()
+    deps = [] if depfile else None
+    try:
+        output_file = OutputFile(output)
+        with output_file as f:
+            crystalize(header, root, out=f, stats=stats, deps=deps, **options)
+        stats.count('output_changed', int(output_file.changed))
+        if depfile:
+            write_depfile(depfile, output, deps)
+    except BaseException:
+        return traceback.format_exc(), stats_dict(header, stats)
+    mismatches = stats.counters.get('abi_mismatches')
+    if mismatches:
+        # Like in single header mode, this is a failure even though the output was written
+        return "Layouts of {} structs and unions differ from C\n".format(mismatches), stats_dict(header, stats)
+    return None, stats_dict(header, stats)
+
+
+def stats_dict(header, stats):
+    if isinstance(header, list):
+        header = [str(path) for path in header]
+    else:
+        header = str(header)
+    result = collections.OrderedDict([('header', header)])
+    result.update(stats.as_dict())
+    return result
+
+def write_profile(path, data):
+    # Write stats as JSON to a file, or to stderr if `path` is '-'
+    text = json.dumps(data, indent=2)
+    if path == '-':
+        err(text)
+    else:
+        with io.open(path, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+
+
+def expand_headers(patterns):
+    # Expand glob patterns (for shells that don't do it); plain paths are kept even if they don't exist
+    for pattern in patterns:
+        if glob.has_magic(pattern):
+            paths = sorted(glob.glob(pattern, recursive=True))
+            if not paths:
+                err("No headers match {}".format(pattern))
+            for path in paths:
+                yield Path(path)
+        else:
+            yield Path(pattern)
+
+
+def crystalize_batch(headers, root, outdir, jobs=None, profile=None, depfiles=False, **options):
+    # Translate many headers in a process pool, each worker reusing its own parser
+    # Every `path/to/header.h` under the include path becomes `outdir/path/to/header.cr`,
+    # with `depfiles` also `outdir/path/to/header.cr.d` (see `write_depfile`)
+    # With `profile`, stats of every header are written there as JSON (see `write_profile`)
+    import concurrent.futures
+
+    tasks = []
+    for header in headers:
+        header_root = Path(root) if root else find_root(header.resolve())
+        try:
+            rel = header.resolve().relative_to(header_root.resolve())
+        except ValueError:
+            rel = Path(header.name)
+        output = Path(outdir)/rel.with_suffix('.cr')
+        tasks.append((header, header_root, output, Path(str(output) + '.d') if depfiles else None))
+
+    failed = 0
+    all_stats = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=get_parser) as executor:
+        futures = collections.OrderedDict(
+            (executor.submit(crystalize_file, *task, **options), task)
+            for task in tasks
+        )
+        for future in concurrent.futures.as_completed(futures):
+            header, _, output, _ = futures[future]
+            stats = {}
+            try:
+                error, stats = future.result()
+                all_stats.append(stats)
+            except Exception:
+                # The worker itself died
+                error = traceback.format_exc()
+            if error:
+                failed += 1
+                err("FAIL {}\n{}".format(header, indent(error.rstrip('\n'), '    ')))
+            else:
+                err("OK   {} -> {}{}".format(header, output, '' if stats.get('counters', {}).get('output_changed') else " (unchanged)"))
+
+    err("{} succeeded, {} failed".format(len(tasks) - failed, failed))
+    if profile:
+        write_profile(profile, all_stats)
+    return failed
+
+
+def handle_request(line, **options):
+    # Server mode: translate the header described by a request (a line of JSON) and return the response
+    # Request: {"id": ..., "header": "path/to/header.h", "root": "path/to/include", "keep_internal": false, "raw_bodies": false,
+    #           "only": ["glob", ...], "roots": ["glob", ...], "recover": false, "verify_abi": false, "profile": false}
+    # Only "header" is required. Response: {"id": ..., "ok": true, "output": "lib ...", "stats": {...}}
+    # or {"id": ..., "ok": false, "error": "..."}; with "verify_abi", also "abi_mismatches": number of types whose layouts differ
+    # (then "ok" is false, but there is the output too)
+    response = collections.OrderedDict()
+    try:
+        request = json.loads(line)
+        if 'id' in request:
+            response['id'] = request['id']
+        out = io.StringIO()
+        stats = Stats()
+        crystalize(request['header'], request.get('root'), out=out, stats=stats,
+            keep_internal=request.get('keep_internal', options.get('keep_internal', False)),
+            raw_bodies=request.get('raw_bodies', options.get('raw_bodies', False)),
+            index=options.get('index'), only=request.get('only', options.get('only')),
+            roots=request.get('roots', options.get('roots')),
+            recover=request.get('recover', options.get('recover', False)),
+            verify_abi=request.get('verify_abi', options.get('verify_abi', False)),
+            cache=options.get('cache'), plugins=options.get('plugins', ()), mapping=options.get('mapping'))
+        response['ok'] = True
+        if request.get('verify_abi', options.get('verify_abi', False)):
+            response['abi_mismatches'] = stats.counters.get('abi_mismatches', 0)
+            if response['abi_mismatches']:
+                response['ok'] = False
+                response['error'] = "Layouts of {} structs and unions differ from C".format(response['abi_mismatches'])
+        response['output'] = out.getvalue()
+        if request.get('profile'):
+            response['stats'] = stats.as_dict()
+    except Exception:
+        response['ok'] = False
+        response['error'] = traceback.format_exc()
+    return json.dumps(response) + '\n'
+
+
+def serve_stdio(jobs=None, **options):
+    # Read requests from stdin, one per line, and write responses to stdout as they are ready
+    # Requests are handled concurrently, so responses may come in a different order; use "id" to match them
+    import concurrent.futures
+    lock = threading.Lock()
+    def respond(line):
+        response = handle_request(line, **options)
+        with lock:
+            sys.stdout.write(response)
+            sys.stdout.flush()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs or 4) as executor:
+        for line in iter(sys.stdin.readline, ''):
+            if line.strip():
+                executor.submit(respond, line)
+
+
+def serve_unix(path, **options):
+    # Accept connections on a Unix socket, each handled in its own thread
+    # Requests and responses are exchanged the same way as in `serve_stdio`, in order within a connection
+    import socketserver
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                if line.strip():
+                    self.wfile.write(handle_request(line.decode('utf-8'), **options).encode('utf-8'))
+                    self.wfile.flush()
+
+    class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    try:
+        # Remove a socket left behind by an earlier server
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+    except OSError:
+        pass
+    server = Server(path, Handler)
+    err("Listening on {}".format(path))
+    # Clean up when stopped by a service manager too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+
+def serve(path, jobs=None, **options):
+    # Server mode: keep the parser and caches warm between requests
+    get_parser()
+    tmp = None
+    if not options.get('cache'):
+        # Without a cache directory, keep a cache just for the server's lifetime
+        tmp = tempfile.mkdtemp(prefix='crystalize')
+        options['cache'] = Cache(tmp)
+    try:
+        if path == '-':
+            serve_stdio(jobs, **options)
+        else:
+            serve_unix(path, **options)
+    finally:
+        if tmp:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate Crystal `lib` definitions from C header files.")
+    parser.add_argument('headers', nargs='*', metavar='header',
+        help="path to the header file (or, with --outdir, any number of headers or glob patterns)")
+    parser.add_argument('-I', '--root', metavar='DIR',
+        help="include path; by default the nearest parent directory named 'include'")
+    parser.add_argument('-d', '--outdir', metavar='DIR',
+        help="batch mode: write one .cr file per header into this directory")
+    parser.add_argument('-o', '--output', metavar='FILE',
+        help="write to this file instead of stdout; it's replaced only when done and only if the contents change")
+    parser.add_argument('--depfile', nargs='?', const='', metavar='FILE',
+        help="write a Make/Ninja-style dependency file listing the headers that were read (default: the output file + '.d'; "
+             "in batch mode always next to each output file)")
+    parser.add_argument('-u', '--umbrella', action='store_true',
+        help="translate all the headers together into one lib, with each declaration once, grouped by the file it's in")
+    parser.add_argument('-j', '--jobs', type=int, metavar='N',
+        help="number of worker processes in batch mode (default: number of CPUs), or threads in stdio server mode")
+    parser.add_argument('--cache-dir', metavar='DIR',
+        help="keep preprocessed sources, parsed ASTs and translated declarations in this directory and reuse them while the headers are unchanged")
+    parser.add_argument('--cache-size', type=int, default=512, metavar='MB',
+        help="evict least recently used cache entries above this size (default: %(default)s)")
+    parser.add_argument('--parse-jobs', type=int, metavar='N',
+        help="split a single header's source and parse the pieces in N processes")
+    parser.add_argument('--keep-internal', action='store_true',
+        help="parse declarations from pycparser's fake libc headers instead of keeping just their typedef names")
+    parser.add_argument('--raw-bodies', action='store_true',
+        help="don't parse bodies of inline functions, copy their source into the comments as is (faster for headers with many of them)")
+    parser.add_argument('--index', metavar='FILE',
+        help="keep the code of every declaration in this SQLite database and take it from there while the headers are unchanged")
+    parser.add_argument('--only', action='append', metavar='PATTERN',
+        help="write just the declarations with names matching this glob pattern (can be repeated)")
+    parser.add_argument('--root-symbol', action='append', dest='roots', metavar='PATTERN',
+        help="write just the declarations with names matching this glob pattern and the types etc. they need (can be repeated)")
+    parser.add_argument('--recover', action='store_true',
+        help="leave out declarations that fail to parse and report all of them, instead of stopping at the first one")
+    parser.add_argument('--verify-abi', action='store_true',
+        help="compile and run a program that checks the layouts of the generated structs and unions; exit with 1 if any differ")
+    parser.add_argument('--profile', metavar='FILE',
+        help="write timings and counters of each phase as JSON to this file ('-' for stderr)")
+    parser.add_argument('--server', nargs='?', const='-', metavar='SOCKET',
+        help="server mode: answer JSON requests, one per line, on this Unix socket, or stdin/stdout if not given")
+    parser.add_argument('--mapping', metavar='FILE',
+        help="JSON file with tables of C names and types and the Crystal ones to use for them, see `load_mapping`")
+    parser.add_argument('--plugin', action='append', default=[], metavar='FILE',
+        help="Python file that customizes the translation, see `load_plugins` (can be repeated)")
+    args = parser.parse_args(argv)
+
+    options = dict(keep_internal=args.keep_internal, raw_bodies=args.raw_bodies, plugins=args.plugin, mapping=args.mapping,
+                   index=args.index, only=args.only, roots=args.roots, recover=args.recover, verify_abi=args.verify_abi)
+    if args.cache_dir:
+        options['cache'] = Cache(args.cache_dir, args.cache_size * 1024 * 1024)
+
+    if args.server:
+        serve(args.server, args.jobs, **options)
+    elif not args.headers:
+        parser.error("a header is required")
+    elif args.outdir is None:
+        if args.depfile is not None and not args.output:
+            parser.error("--depfile requires --output, the target it names")
+        headers = args.headers
+        root = args.root
+        # Old style invocation: the include path is the second argument
+        if len(headers) == 2 and root is None and not args.umbrella:
+            headers, root = headers[:1], headers[1]
+        if args.umbrella:
+            headers = [str(header) for header in expand_headers(headers)]
+        elif len(headers) != 1:
+            parser.error("multiple headers require --outdir or --umbrella")
+        else:
+            headers = headers[0]
+        stats = Stats()
+        if args.output:
+            deps = [] if args.depfile is not None else None
+            with OutputFile(args.output) as f:
+                crystalize(headers, root, out=f, parse_jobs=args.parse_jobs, stats=stats, deps=deps, **options)
+            if deps is not None:
+                write_depfile(args.depfile or args.output + '.d', args.output, deps)
+        else:
+            crystalize(headers, root, parse_jobs=args.parse_jobs, stats=stats, **options)
+        if args.profile:
+            write_profile(args.profile, stats_dict(headers, stats))
+        if stats.counters.get('abi_mismatches'):
+            sys.exit(1)
+    elif args.umbrella:
+        parser.error("--umbrella writes one lib, it can't be used with --outdir")
+    elif args.output:
+        parser.error("--output names one file, it can't be used with --outdir")
+    else:
+        headers = list(expand_headers(args.headers))
+        if crystalize_batch(headers, args.root, args.outdir, args.jobs, args.profile, args.depfile is not None, **options):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+# An on-disk index of the top-level declarations of translated headers
+# It keeps the Crystal code of every declaration, so any selection of them can be written again
+# without preprocessing and parsing headers that haven't changed
+
+import json
+import fnmatch
+import sqlite3
+import collections
+
+from cache import file_digest
+
+
+def matches(name, patterns):
+    # Check if a declaration's name matches any of the glob patterns (case-sensitive)
+    return name is not None and any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns)
+
+
+def reachable(symbols, roots):
+    # Positions of the declarations needed by those with names matching the glob patterns `roots`:
+    # the transitive closure over the names they refer to (see `util.symbol_keys`)
+    # `symbols` are dicts with 'name', 'declares' and 'references'
+    declared_by = collections.defaultdict(list)
+    for i, symbol in enumerate(symbols):
+        for key in symbol['declares']:
+            declared_by[tuple(key)].append(i)
+    result = set()
+    todo = [i for i, symbol in enumerate(symbols) if matches(symbol['name'], roots)]
+    while todo:
+        i = todo.pop()
+        if i in result:
+            continue
+        result.add(i)
+        for key in symbols[i]['references']:
+            todo.extend(declared_by.get(tuple(key), ()))
+    return result
+
+
+class SymbolIndex(object):
+    # Increased when the tables change; an index of another version is emptied
+    version = 2
+
+    # A "unit" is one run of the translation: the header(s) with the include path and options, see `crystalize`
+    def __init__(self, path):
+        # Batch workers write to the same file, so wait for each other's transactions
+        self.db = sqlite3.connect(str(path), timeout=60)
+        with self.db:
+            if self.db.execute('PRAGMA user_version').fetchone()[0] != self.version:
+                self.db.executescript('''
+                    DROP TABLE IF EXISTS units;
+                    DROP TABLE IF EXISTS symbols;
+                    PRAGMA user_version = {};
+                '''.format(self.version))
+            self.db.executescript('''
+                CREATE TABLE IF NOT EXISTS units (
+                    unit TEXT PRIMARY KEY,
+                    -- JSON list of [path, digest of contents] of the files the unit was produced from
+                    deps TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS symbols (
+                    unit TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    name TEXT,
+                    kind TEXT,
+                    file TEXT,
+                    line INTEGER,
+                    -- `util.ast_digest` of the declaration
+                    hash TEXT,
+                    -- JSON lists from `util.symbol_keys`
+                    declares TEXT NOT NULL,
+                    refs TEXT NOT NULL,
+                    -- JSON lists of pieces of Crystal code inside and after the lib
+                    lib_code TEXT NOT NULL,
+                    code TEXT NOT NULL,
+                    PRIMARY KEY (unit, position)
+                );
+                CREATE INDEX IF NOT EXISTS symbols_name ON symbols (name);
+            ''')
+
+    def close(self):
+        self.db.close()
+
+    def fresh(self, unit):
+        # Return the files the unit was produced from, if it is in the index and none of them have changed since
+        row = self.db.execute('SELECT deps FROM units WHERE unit = ?', (unit,)).fetchone()
+        if row is None:
+            return None
+        deps = json.loads(row[0])
+        # There are no files if preprocessing failed (the header itself is always one of them)
+        if deps and all(file_digest(path) == old for path, old in deps):
+            return [path for path, old in deps]
+
+    def store(self, unit, deps, symbols):
+        # Replace the unit's declarations; `symbols` are dicts with the columns of the symbols table
+        # A unit produced from no files (so preprocessing must have failed) isn't stored, see `fresh`
+        if not deps:
+            return
+        deps = [[dep, file_digest(dep)] for dep in sorted(set(deps))]
+        with self.db:
+            self.db.execute('DELETE FROM symbols WHERE unit = ?', (unit,))
+            self.db.execute('INSERT OR REPLACE INTO units VALUES (?, ?)', (unit, json.dumps(deps)))
+            self.db.executemany(
+                'INSERT INTO symbols VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                ((unit, position, s['name'], s['kind'], s['file'], s['line'], s['hash'],
+                  json.dumps(s['declares']), json.dumps(s['references']), json.dumps(s['lib_code']), json.dumps(s['code']))
+                 for position, s in enumerate(symbols))
+            )
+
+    def symbols(self, unit):
+        # Yield the unit's declarations in their original order
+        # (they are selected with `matches` afterwards, the same way as when translating)
+        query = 'SELECT name, kind, file, line, hash, declares, refs, lib_code, code FROM symbols WHERE unit = ? ORDER BY position'
+        for name, kind, file, line, hash, declares, refs, lib_code, code in self.db.execute(query, (unit,)):
+            yield dict(name=name, kind=kind, file=file, line=line, hash=hash,
+                       declares=json.loads(declares), references=json.loads(refs),
+                       lib_code=json.loads(lib_code), code=json.loads(code))
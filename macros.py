@@ -0,0 +1,394 @@
+# Evaluation of object-like macros (`#define NAME value`), so they can become constants with their actual values
+# Types follow the LP64 data model, and are named after Crystal's number suffixes (i32, u64, f32...)
+
+import re
+import collections
+
+
+_token_re = re.compile(r'''
+    (?P<float>(?:[0-9]+\.[0-9]*|\.[0-9]+)(?:[eE][-+]?[0-9]+)?[fFlL]?|[0-9]+[eE][-+]?[0-9]+[fFlL]?)
+  | (?P<int>(?:0[xX][0-9a-fA-F]+|0[bB][01]+|[0-9]+)[uUlL]*)
+  | (?P<char>[LuU]?'(?:\\.|[^'\\])+')
+  | (?P<string>(?:u8|[LuU])?"(?:\\.|[^"\\])*")
+  | (?P<name>[a-zA-Z_][a-zA-Z_0-9]*)
+  | (?P<op><<|>>|<=|>=|==|!=|&&|\|\||[-+*/%~!<>&^|?:()])
+  | (?P<space>\s+)
+  | (?P<other>.)
+''', re.VERBOSE)
+
+def tokenize(text):
+    # Split the value of a macro into (kind, text) tokens, or return None if it has something that can't be evaluated
+    tokens = []
+    for m in _token_re.finditer(text):
+        kind = m.lastgroup
+        if kind == 'space':
+            continue
+        if kind == 'other':
+            return None
+        tokens.append((kind, m.group()))
+    return tokens
+
+
+# The result of evaluating a macro
+# `text` is the Crystal literal, if the macro is just a literal (possibly through other macros)
+Value = collections.namedtuple('Value', 'value type text')
+
+class Unresolved(Exception):
+    pass
+
+
+def _bits(type):
+    return int(type[1:])
+
+def wrap(value, type):
+    # Convert an integer to the range of the type, as C does
+    bits = _bits(type)
+    value &= (1 << bits) - 1
+    if type[0] == 'i' and value >= 1 << (bits - 1):
+        value -= 1 << bits
+    return value
+
+def _fits(value, type):
+    return wrap(value, type) == value
+
+
+_integer_words = {'signed', 'unsigned', 'char', 'short', 'int', 'long'}
+_named_types = {
+    'size_t': 'u64', 'uintptr_t': 'u64', 'ssize_t': 'i64', 'intptr_t': 'i64', 'ptrdiff_t': 'i64',
+    'float': 'f32', 'double': 'f64',
+}
+
+def cast_type(words):
+    # The type named by the words inside a cast's parentheses, or None if they aren't a known arithmetic type
+    words = [word for word in words if word not in ('const', 'volatile')]
+    if len(words) == 1:
+        if words[0] in _named_types:
+            return _named_types[words[0]]
+        m = re.match(r'^_*(u?)int(8|16|32|64)(?:_t)?$', words[0])
+        if m:
+            return ('u' if m.group(1) else 'i') + m.group(2)
+    if words == ['long', 'double']:
+        return 'f64'
+    if not words or not all(word in _integer_words for word in words):
+        return None
+    if 'char' in words:
+        bits = 8
+    elif 'short' in words:
+        bits = 16
+    elif 'long' in words:
+        bits = 64
+    else:
+        bits = 32
+    return ('u' if 'unsigned' in words else 'i') + str(bits)
+
+
+def int_literal(text):
+    # Value of a C integer literal, with the type C gives it and the equivalent Crystal literal
+    m = re.match(r'^(0[xX][0-9a-fA-F]+|0[bB][01]+|[0-9]+)([uUlL]*)$', text)
+    digits, suffix = m.group(1), m.group(2).lower()
+    decimal = not digits[0] == '0' or digits == '0'
+    if decimal:
+        value = int(digits)
+    elif digits[1] in 'xXbB':
+        value = int(digits, 0)
+    else:
+        value = int(digits, 8)
+        digits = '0o' + digits[1:]
+    # The first type that fits, as C does
+    if 'u' in suffix:
+        candidates = ['u64'] if 'l' in suffix else ['u32', 'u64']
+    elif 'l' in suffix:
+        candidates = ['i64'] if decimal else ['i64', 'u64']
+    else:
+        candidates = ['i32', 'i64'] if decimal else ['i32', 'u32', 'i64', 'u64']
+    for type in candidates:
+        if _fits(value, type):
+            break
+    else:
+        raise Unresolved(text)
+    return Value(value, type, digits + ('' if type == 'i32' else '_' + type))
+
+def float_literal(text):
+    type = 'f32' if text[-1] in 'fF' else 'f64'
+    text = text.rstrip('fFlL')
+    mantissa, e, exponent = text.lower().partition('e')
+    # Crystal requires digits on both sides of the point
+    if mantissa.startswith('.'):
+        mantissa = '0' + mantissa
+    if mantissa.endswith('.'):
+        mantissa += '0'
+    return Value(float(text), type, mantissa + e + exponent + ('_f32' if type == 'f32' else ''))
+
+def char_literal(text):
+    text = text.lstrip('LuU')
+    try:
+        char = text[1:-1].encode('latin-1').decode('unicode_escape')
+    except (UnicodeError, ValueError):
+        raise Unresolved(text)
+    if len(char) != 1:
+        raise Unresolved(text)
+    return Value(ord(char), 'i32', text)
+
+
+def common_type(a, b):
+    # The type that the operands of a binary operator are converted to
+    if a[0] == 'f' or b[0] == 'f':
+        return 'f64' if 'f64' in (a, b) else 'f32'
+    a, b = promote(a), promote(b)
+    if a == b:
+        return a
+    if _bits(a) != _bits(b):
+        # The larger type can represent all values of the smaller one
+        return a if _bits(a) > _bits(b) else b
+    return 'u' + str(_bits(a))
+
+def promote(type):
+    # Types smaller than int become int
+    if type[0] != 'f' and _bits(type) < 32:
+        return 'i32'
+    return type
+
+def convert(value, type):
+    if value.type == 'str':
+        raise Unresolved(value)
+    if type[0] == 'f':
+        return Value(float(value.value), type, None)
+    if value.type[0] == 'f':
+        return Value(wrap(int(value.value), type), type, None)
+    return Value(wrap(value.value, type), type, None)
+
+
+def _truncdiv(a, b):
+    # C division rounds toward zero
+    q = abs(a) // abs(b)
+    return q if (a < 0) == (b < 0) else -q
+
+def _binary(op, a, b):
+    if a.type == 'str' or b.type == 'str':
+        raise Unresolved(op)
+    if op in ('&&', '||'):
+        result = (a.value and b.value) if op == '&&' else (a.value or b.value)
+        return Value(int(bool(result)), 'i32', None)
+    if op in ('<<', '>>'):
+        if a.type[0] == 'f' or b.type[0] == 'f' or not 0 <= b.value < 64:
+            raise Unresolved(op)
+        type = promote(a.type)
+        value = a.value << b.value if op == '<<' else a.value >> b.value
+        return Value(wrap(value, type), type, None)
+    type = common_type(a.type, b.type)
+    x, y = convert(a, type).value, convert(b, type).value
+    if op in ('==', '!=', '<', '<=', '>', '>='):
+        result = {'==': x == y, '!=': x != y, '<': x < y, '<=': x <= y, '>': x > y, '>=': x >= y}[op]
+        return Value(int(result), 'i32', None)
+    if op in ('/', '%') and not y:
+        raise Unresolved(op)
+    if type[0] == 'f':
+        if op in ('%', '&', '^', '|'):
+            raise Unresolved(op)
+        value = x / y if op == '/' else {'+': x + y, '-': x - y, '*': x * y}[op]
+        return Value(value, type, None)
+    if op == '/':
+        value = _truncdiv(x, y)
+    elif op == '%':
+        value = x - _truncdiv(x, y) * y
+    else:
+        value = {'+': x + y, '-': x - y, '*': x * y, '&': x & y, '^': x ^ y, '|': x | y}[op]
+    return Value(wrap(value, type), type, None)
+
+# Binary operators by precedence, from lowest
+_precedence = {
+    '||': 1, '&&': 2, '|': 3, '^': 4, '&': 5, '==': 6, '!=': 6,
+    '<': 7, '<=': 7, '>': 7, '>=': 7, '<<': 8, '>>': 8, '+': 9, '-': 9, '*': 10, '/': 10, '%': 10,
+}
+
+
+# Evaluates the tokens of one macro; names are looked up with `lookup(name)`, which returns a `Value` or raises `Unresolved`
+class Evaluator(object):
+    def __init__(self, tokens, lookup):
+        self.tokens = tokens
+        self.pos = 0
+        self.lookup = lookup
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return (None, None)
+
+    def next(self):
+        token = self.peek()
+        if token[0] is None:
+            raise Unresolved("unexpected end")
+        self.pos += 1
+        return token
+
+    def expect(self, text):
+        if self.next()[1] != text:
+            raise Unresolved("expected " + text)
+
+    def evaluate(self):
+        result = self.conditional()
+        if self.pos != len(self.tokens):
+            raise Unresolved("unexpected " + self.peek()[1])
+        return result
+
+    def conditional(self):
+        cond = self.binary(1)
+        if self.peek()[1] != '?':
+            return cond
+        self.next()
+        a = self.conditional()
+        self.expect(':')
+        b = self.conditional()
+        if cond.type == 'str':
+            raise Unresolved('?')
+        result = a if cond.value else b
+        if a.type != 'str' and b.type != 'str':
+            result = convert(result, common_type(a.type, b.type))
+        return result
+
+    def binary(self, level):
+        left = self.unary()
+        while True:
+            kind, op = self.peek()
+            if kind != 'op' or _precedence.get(op, 0) < level:
+                return left
+            self.next()
+            right = self.binary(_precedence[op] + 1)
+            left = _binary(op, left, right)
+
+    def unary(self):
+        kind, text = self.peek()
+        if kind == 'op' and text in ('-', '+', '~', '!'):
+            self.next()
+            value = self.unary()
+            if value.type == 'str':
+                raise Unresolved(text)
+            if text == '!':
+                return Value(int(not value.value), 'i32', None)
+            type = promote(value.type)
+            if text == '-':
+                if type[0] == 'f':
+                    return Value(-value.value, type, None)
+                return Value(wrap(-value.value, type), type, None)
+            if text == '~':
+                if type[0] == 'f':
+                    raise Unresolved(text)
+                return Value(wrap(~value.value, type), type, None)
+            return convert(value, type)
+        if text == '(':
+            # A cast or parentheses
+            end = self.pos + 1
+            while end < len(self.tokens) and self.tokens[end][0] == 'name':
+                end += 1
+            type = None
+            if end < len(self.tokens) and self.tokens[end][1] == ')':
+                type = cast_type([token[1] for token in self.tokens[self.pos + 1:end]])
+            if type:
+                self.pos = end + 1
+                return convert(self.unary(), type)
+        return self.primary()
+
+    def primary(self):
+        kind, text = self.next()
+        if kind == 'op' and text == '(':
+            result = self.conditional()
+            self.expect(')')
+            return result
+        if kind == 'int':
+            return int_literal(text)
+        if kind == 'float':
+            return float_literal(text)
+        if kind == 'char':
+            return char_literal(text)
+        if kind == 'string':
+            # Adjacent strings are joined
+            parts = [text]
+            while self.peek()[0] == 'string':
+                parts.append(self.next()[1])
+            contents = ''.join(part[part.index('"') + 1:-1] for part in parts)
+            return Value(contents, 'str', '"{}"'.format(contents))
+        if kind == 'name':
+            return self.lookup(text)
+        raise Unresolved(text)
+
+
+def crystal_value(value):
+    # Crystal code for a `Value`
+    if value.text is not None:
+        return value.text
+    if value.type[0] == 'f':
+        if value.value != value.value or value.value in (float('inf'), float('-inf')):
+            return None
+        result = repr(value.value)
+        return result + '_f32' if value.type == 'f32' else result
+    return str(value.value) + ('' if value.type == 'i32' else '_' + value.type)
+
+
+# All the object-like macros of a translation unit, as seen by the preprocessor
+class Macros(object):
+    def __init__(self):
+        # Name -> text of the latest definition
+        self.definitions = collections.OrderedDict()
+        # Name -> `Value`, or None if it can't be evaluated; filled on first use by `evaluate`
+        self.values = None
+
+    def define(self, name, text):
+        self.definitions[name] = text
+        self.values = None
+
+    def undef(self, name):
+        self.definitions.pop(name, None)
+        self.values = None
+
+    def evaluate(self):
+        # Evaluate every macro once, after the macros it refers to (a depth-first topological order)
+        # Cycles and references to unknown names leave the macros involved unresolved
+        tokens = {}
+        values = {}
+        for root in self.definitions:
+            if root in values:
+                continue
+            # Stack of [name, names it depends on that are still to be visited]
+            stack = [[root, None]]
+            visiting = {root}
+            while stack:
+                item = stack[-1]
+                name = item[0]
+                if item[1] is None:
+                    tokens[name] = tokenize(self.definitions[name])
+                    item[1] = [text for kind, text in tokens[name] or () if kind == 'name' and text in self.definitions]
+                if item[1]:
+                    dep = item[1].pop()
+                    if dep not in values and dep not in visiting:
+                        visiting.add(dep)
+                        stack.append([dep, None])
+                    continue
+                stack.pop()
+                visiting.discard(name)
+                values[name] = self._evaluate(tokens[name], values)
+        self.values = values
+
+    def _evaluate(self, tokens, values):
+        if not tokens:
+            return None
+        def lookup(name):
+            value = values.get(name)
+            if value is None:
+                raise Unresolved(name)
+            return value
+        try:
+            return Evaluator(tokens, lookup).evaluate()
+        except Unresolved:
+            return None
+
+    def value(self, name):
+        # The `Value` of a macro, or None if it can't be evaluated
+        if self.values is None:
+            self.evaluate()
+        return self.values.get(name)
+
+    def crystal(self, name):
+        # Crystal code for the value of a macro, or None if it can't be evaluated
+        value = self.value(name)
+        if value is not None:
+            return crystal_value(value)
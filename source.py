@@ -0,0 +1,335 @@
+# Processing of preprocessed C source before it is passed to pycparser
+
+import io
+import re
+import hashlib
+
+
+_define_re = re.compile(r'[ \t]*#define +([a-zA-Z_][_a-zA-Z_0-9]*) +(.+)$')
+_attribute_re = re.compile(r'__attribute__[ \t]*\(\(.+\)\)')
+
+
+def rewrite(lines, skip_file=None, bodies=None, macros=None):
+    # Clean up the output of the preprocessor so pycparser can parse it, in one pass over its lines.
+    # `lines` can be any iterable, such as a pipe from the preprocessor, so the work overlaps with preprocessing.
+    # Declarations coming from files for which `skip_file(path)` is true are dropped, except that
+    # typedefs are replaced with `typedef int name;`, because the parser needs to know which names are types.
+    # If `bodies` is a dict, bodies of function definitions are replaced with `{"key";}` so the parser doesn't go through them,
+    # and their source is put in the dict by that key (a hash of it). Line breaks are kept, so positions don't change.
+    # Definitions of macros from all files are passed to `macros` (a `macros.Macros`), if given.
+
+    # Hack to change all defines into fake constants, so they can be parsed later by pycparser
+    # First we need a fake type to distinguish them
+    result = io.StringIO()
+    result.write('\ntypedef int _DEFINE;\n')
+    writing = True
+
+    scanner = None
+    if skip_file is not None or bodies is not None:
+        scanner = StatementScanner()
+    # Lines of the function body being replaced
+    body = None
+    skipping = False
+    if skip_file is not None:
+        skipped_files = {}
+        # Lines of the statement being skipped
+        group = []
+        typedefs = set()
+
+    for line in lines:
+        line = line.rstrip('\r\n')
+        stripped = line.lstrip(' \t')
+        if stripped.startswith('#'):
+            # Discard #if... (the branch after #ifn... is kept)
+            if stripped.startswith('#if'):
+                writing = stripped.startswith('#ifn')
+                line = ''
+            elif stripped.startswith('#el'):
+                writing = not writing
+                line = ''
+            elif stripped.startswith('#end'):
+                writing = True
+                line = ''
+            elif not writing:
+                line = ''
+            elif stripped.startswith('#define'):
+                m = _define_re.match(line)
+                if m and macros is not None:
+                    macros.define(m.group(1), m.group(2))
+                if m:
+                    # Replace macros without arguments with consts
+                    line = 'const _DEFINE {} = "{}";'.format(m.group(1), m.group(2).replace('\\', '\\\\').replace('"', '\\"'))
+                else:
+                    # Discard the rest
+                    line = ''
+            elif stripped.startswith('#undef'):
+                if macros is not None and len(stripped.split()) > 1:
+                    macros.undef(stripped.split()[1])
+                line = ''
+        elif not writing:
+            line = ''
+
+        # Discard attributes
+        if '__attribute__' in line:
+            line = _attribute_re.sub('', line)
+
+        if scanner is not None:
+            if line.lstrip(' \t').startswith('#'):
+                scanner.feed(line)
+                # Keep line markers, so positions are known after skipped parts
+                if skipping and not _linemarker_re.match(line.strip()):
+                    continue
+            else:
+                if skip_file is not None and scanner.depth == 0 and not scanner.pending:
+                    # A statement starts here
+                    try:
+                        skipping = skipped_files[scanner.file]
+                    except KeyError:
+                        skipping = skipped_files[scanner.file] = bool(skip_file(scanner.file))
+                at_end = scanner.feed(line)
+                if skipping:
+                    group.append(line)
+                    if at_end:
+                        code = '\n'.join(group)
+                        group = []
+                        if 'typedef' in code:
+                            names = typedef_names(code, typedefs)
+                            typedefs.update(names)
+                            for name in names:
+                                result.write('typedef int {};\n'.format(name))
+                    continue
+                if bodies is not None and (body is not None or scanner.body_marks):
+                    # Keep just the braces, and the key at the end; a line may end one body and start another
+                    kept = []
+                    pos = 0
+                    for opening, at in scanner.body_marks:
+                        if opening:
+                            kept.append(line[pos:at] + '{')
+                            body = []
+                        else:
+                            body.append(line[pos:at])
+                            text = '\n'.join(body)
+                            key = hashlib.sha1(text.encode('utf-8')).hexdigest()
+                            bodies[key] = text
+                            kept.append('"{}";}}'.format(key))
+                            body = None
+                        pos = at
+                    if body is not None:
+                        body.append(line[pos:])
+                    else:
+                        kept.append(line[pos:])
+                    line = ''.join(kept)
+
+        result.write(line)
+        result.write('\n')
+
+    return result.getvalue()
+
+
+# Tokens that matter for finding the ends of top-level statements; everything else is skipped
+_bracket_re = re.compile(r'''"(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*'|[][{}();]''')
+_linemarker_re = re.compile(r'#(?:line)?[ \t]+([0-9]+)(?:[ \t]+"((?:\\.|[^"\\])*)")?')
+
+# Follows C source fed to it line by line (after preprocessing) to tell where top-level statements end
+# and which file and line the next line comes from
+class StatementScanner(object):
+    def __init__(self):
+        self.depth = 0
+        # Whether the current top-level braces are a function body (which ends a statement without a semicolon)
+        self.function = False
+        # Whether there is code after the last statement that ended
+        self.pending = False
+        # The last significant character seen
+        self.last = ''
+        self.file = ''
+        self.line = 1
+        # Where function bodies start and end in the last line: (True, position of '{') and (False, position after '}')
+        self.body_marks = []
+
+    def feed(self, line):
+        # Returns True if the line ends at a statement boundary: no statement is left open after it
+        self.body_marks = []
+        stripped = line.strip()
+        if stripped.startswith('#'):
+            m = _linemarker_re.match(stripped)
+            if m:
+                self.line = int(m.group(1))
+                if m.group(2) is not None:
+                    self.file = m.group(2)
+            else:
+                # Such as #pragma
+                self.line += 1
+            return self.depth == 0 and not self.pending
+        self.line += 1
+        if not stripped:
+            return self.depth == 0 and not self.pending
+
+        end = None
+        for m in _bracket_re.finditer(line):
+            c = m.group()
+            if c == '{' or c == '(' or c == '[':
+                if c == '{' and self.depth == 0:
+                    before = line[:m.start()].rstrip()
+                    self.function = (before[-1:] if before else self.last) == ')'
+                    if self.function:
+                        self.body_marks.append((True, m.start()))
+                self.depth += 1
+            elif c == '}' or c == ')' or c == ']':
+                self.depth -= 1
+                if c == '}' and self.depth == 0 and self.function:
+                    self.function = False
+                    end = m.end()
+                    self.body_marks.append((False, end))
+            elif c == ';' and self.depth == 0:
+                end = m.end()
+        self.last = stripped[-1]
+        if end is None:
+            self.pending = True
+        else:
+            self.pending = bool(line[end:].strip())
+        return self.depth == 0 and not self.pending
+
+    def marker(self):
+        # A line marker that makes the parser continue from the current position
+        return '# {} "{}"'.format(self.line, self.file)
+
+
+_directive_re = re.compile(r'^[ \t]*#.*$', re.MULTILINE)
+_token_re = re.compile(r'''"(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*'|[a-zA-Z_][a-zA-Z_0-9]*|\S''')
+_not_names = set('''
+    typedef struct union enum const volatile restrict signed unsigned short long int char float double void
+    _Bool _Complex _Atomic static extern inline register auto __extension__ __inline __inline__ __restrict
+    __restrict__ __const __volatile__ __signed__ __int128
+'''.split())
+# Followed by an expression or type in parentheses, which isn't part of the declarator either
+_typeof_names = {'typeof', '__typeof', '__typeof__'}
+
+def typedef_names(code, known=frozenset()):
+    # Find names declared by typedefs in a piece of top-level C code
+    # `known` are typedef names declared before, which may appear as the base type
+    names = []
+    statement = []
+    depth = 0
+    # Line markers and other directives (which statements can start with, see `split_statements`) aren't C code
+    code = _directive_re.sub('', code)
+    for token in _token_re.findall(code):
+        if token == '{':
+            depth += 1
+        elif token == '}':
+            depth -= 1
+            if depth == 0:
+                # Stands for the body of a struct, union or enum
+                statement.append('{}')
+        elif depth == 0:
+            if token == ';':
+                if statement and statement[0] == 'typedef':
+                    names.extend(_declarator_names(statement, known, names))
+                statement = []
+            else:
+                statement.append(token)
+    return names
+
+def _declarator_names(tokens, known, seen):
+    # The declared name in each declarator of a statement is the first identifier that isn't part of the type
+    names = []
+    found = False
+    depth = 0
+    after_tag = False
+    # Depth of the parentheses after typeof while inside them, and whether they are next
+    in_typeof = None
+    typeof_next = False
+    for token in tokens:
+        if in_typeof is not None:
+            if token == '(':
+                depth += 1
+            elif token == ')':
+                depth -= 1
+                if depth == in_typeof:
+                    in_typeof = None
+            continue
+        if typeof_next and token == '(':
+            typeof_next = False
+            in_typeof = depth
+            depth += 1
+        elif token in _typeof_names:
+            typeof_next = True
+        elif token in ('(', '['):
+            depth += 1
+        elif token in (')', ']'):
+            depth -= 1
+        elif token == ',' and depth == 0:
+            found = False
+        elif token == '{}':
+            after_tag = False
+        elif not found and (token[0].isalpha() or token[0] == '_'):
+            if after_tag:
+                # The tag of a struct, union or enum
+                after_tag = False
+            elif token in ('struct', 'union', 'enum'):
+                after_tag = True
+            elif token not in _not_names and token not in known and token not in seen:
+                names.append(token)
+                found = True
+    return names
+
+
+def split_chunks(src, count):
+    # Split preprocessed source into about `count` pieces of similar size at top-level statement boundaries,
+    # so that they can be parsed separately.
+    # Returns a list of (code, typedef names declared before it); every piece after the first starts with a line marker.
+    target = len(src) // count + 1
+    chunks = []
+    typedefs = []
+    known = set()
+    scanner = StatementScanner()
+    lines = []
+    size = 0
+    group = []
+    start_typedefs = []
+    for line in src.splitlines(True):
+        lines.append(line)
+        group.append(line)
+        size += len(line)
+        if scanner.feed(line):
+            code = ''.join(group)
+            if 'typedef' in code:
+                names = typedef_names(code, known)
+                typedefs.extend(names)
+                known.update(names)
+            group = []
+            if size >= target:
+                chunks.append((''.join(lines), start_typedefs))
+                lines = [scanner.marker() + '\n']
+                start_typedefs = list(typedefs)
+                size = 0
+    if len(lines) > 1 or not chunks:
+        chunks.append((''.join(lines), start_typedefs))
+    return chunks
+
+
+def split_statements(src):
+    # Split preprocessed source into top-level statements, so that any run of them can be parsed on its own.
+    # Returns a list of (code, number of typedef names declared before it) and the list of those names;
+    # every statement after the first starts with a line marker.
+    statements = []
+    typedefs = []
+    known = set()
+    scanner = StatementScanner()
+    marker = ''
+    group = []
+    for line in src.splitlines(True):
+        group.append(line)
+        stripped = line.strip()
+        # Blank lines and line markers go with the statement after them
+        if scanner.feed(line) and stripped and not stripped.startswith('#'):
+            code = ''.join(group)
+            statements.append((marker + code, len(typedefs)))
+            if 'typedef' in code:
+                names = typedef_names(code, known)
+                typedefs.extend(names)
+                known.update(names)
+            group = []
+            marker = scanner.marker() + '\n'
+    if group:
+        statements.append((marker + ''.join(group), len(typedefs)))
+    return statements, typedefs
@@ -0,0 +1,41 @@
+# Regression checks for the translation in crystalize.py; run with `python -m pytest`
+
+import io
+
+from crystalize import Translator, LibWriter
+from util import get_parser
+
+
+def translate(src):
+    # Crystal code for C source that needs no preprocessing
+    out = io.StringIO()
+    writer = LibWriter(out)
+    # Declarations without a file are taken as internal ones
+    Translator(get_parser().parse(src, 'test.h'), writer).translate()
+    writer.close()
+    return out.getvalue()
+
+
+def test_typedef_of_opaque_tag():
+    # The tag is never defined, so the typedef is the opaque type
+    result = translate('typedef struct handle_s Handle;\nHandle *handle_open(void);\n')
+    assert 'type Handle = Void*' in result
+    assert ': Handle\n' in result
+    assert 'HandleS' not in result
+
+def test_typedef_of_tag_defined_by_typedef():
+    # The struct is created with the name of the first typedef, not of its tag
+    result = translate('typedef struct node_s {int v;} Node;\ntypedef struct node_s NodeAlias;\nNodeAlias *first(void);\n')
+    assert 'struct Node\n' in result
+    assert 'alias NodeAlias = Node\n' in result
+    assert 'NodeS' not in result
+    assert ': NodeAlias*' in result
+
+def test_typedef_of_alias_of_opaque():
+    result = translate('typedef struct _Foo Foo;\ntypedef Foo FooAlias;\nFooAlias *foo(void);\n')
+    assert ': FooAlias\n' in result
+
+def test_typedef_of_tag_defined_later():
+    result = translate('typedef struct Later Later_t;\nvoid use(Later_t *p);\nstruct Later { int x; };\n')
+    assert 'alias LaterT = Later' in result
+    assert 'p : LaterT*' in result
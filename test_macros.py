@@ -0,0 +1,70 @@
+# Regression checks for macros.py; run with `python -m pytest`
+
+import io
+
+from macros import Macros
+from source import rewrite
+from crystalize import Translator, LibWriter
+from util import get_parser
+
+
+def values(*definitions):
+    # Crystal values of macros defined one after another, as (name, text) pairs
+    macros = Macros()
+    for name, text in definitions:
+        macros.define(name, text)
+    return {name: macros.crystal(name) for name, text in definitions}
+
+
+def test_literal_types():
+    # Hex literals that don't fit in int are unsigned, as in C
+    assert values(('A', '0xFFFFFFFF'))['A'] == '0xFFFFFFFF_u32'
+    assert values(('A', '0x7FFFFFFF'))['A'] == '0x7FFFFFFF'
+    assert values(('A', '010'))['A'] == '0o10'
+    assert values(('A', '1.5f'))['A'] == '1.5_f32'
+    assert values(('A', '"a" "b"'))['A'] == '"ab"'
+
+def test_arithmetic():
+    assert values(('A', '~0UL'))['A'] == '18446744073709551615_u64'
+    assert values(('A', '(unsigned char)-1'))['A'] == '255_u8'
+    assert values(('A', '(int)3.9'))['A'] == '3'
+    # Division and remainder truncate towards zero
+    assert values(('A', '-7/2'))['A'] == '-3'
+    assert values(('A', '-7 % 2'))['A'] == '-1'
+    # Wraps around like int does
+    assert values(('A', '1 << 31'))['A'] == '-2147483648'
+
+def test_references():
+    # Macros are expanded where they are used, so the order of definitions doesn't matter
+    assert values(('A', 'B + 1'), ('B', '2')) == {'A': '3', 'B': '2'}
+    # Cycles and things that can't be evaluated are left as they are
+    assert values(('A', 'B'), ('B', 'A')) == {'A': None, 'B': None}
+    assert values(('A', 'sizeof(int)'))['A'] is None
+
+def test_undef():
+    macros = Macros()
+    macros.define('A', '1')
+    macros.define('B', 'A + 1')
+    macros.undef('A')
+    assert macros.crystal('A') is None
+    assert macros.crystal('B') is None
+
+
+def translate(src):
+    # Crystal code for C source with macro definitions (as the preprocessor passes them on with -dD)
+    macros = Macros()
+    # Declarations without a file are taken as internal ones
+    src = '# 1 "test.h"\n' + src
+    c_ast = get_parser().parse(rewrite(io.StringIO(src), macros=macros))
+    out = io.StringIO()
+    writer = LibWriter(out)
+    Translator(c_ast, writer, macros=macros).translate()
+    writer.close()
+    return out.getvalue()
+
+def test_redefinition():
+    # A lib can't have a constant twice; it has the final definition, which is what C code sees after the header
+    result = translate('#define V 1\n#define W (V+1)\n#undef V\n#define V 2\n')
+    assert result.count('V = ') == 1
+    assert 'V = 2\n' in result
+    assert 'W = 3\n' in result
@@ -0,0 +1,21 @@
+# Regression checks for source.py; run with `python -m pytest`
+
+from source import typedef_names, split_statements
+
+
+def test_typedef_after_line_marker():
+    # Statements start with the line markers and blank lines before them
+    assert typedef_names('# 1 "x.h"\ntypedef int T;\n') == ['T']
+    assert typedef_names('\n# 1 "x.h"\n\ntypedef struct S S;\n') == ['S']
+
+def test_split_statements_typedefs():
+    src = '# 1 "x.h"\ntypedef int GoodT;\nint good1(GoodT x);\n# 3 "x.h"\ntypedef struct { GoodT g; } AfterT;\n'
+    statements, typedefs = split_statements(src)
+    assert typedefs == ['GoodT', 'AfterT']
+    # Number of typedef names declared before each statement
+    assert [count for code, count in statements] == [0, 1, 1]
+
+def test_typedef_of_typeof():
+    # The parenthesized part isn't a declarator
+    assert typedef_names('typedef __typeof__(sizeof(0)) mysize;') == ['mysize']
+    assert typedef_names('typedef typeof(int (*)(void)) fp, *fpp;') == ['fp', 'fpp']
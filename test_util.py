@@ -0,0 +1,16 @@
+# Regression checks for util.py; run with `python -m pytest`
+
+from util import get_parser, symbol_keys, top_name
+
+
+def keys(src):
+    return {top_name(top): symbol_keys(top) for top in get_parser().parse(src, 'test.h').ext}
+
+
+def test_symbol_keys_of_tags():
+    result = keys('struct Bar { int x; struct Bar *next; };\ntypedef struct Bar Bar2;\nstruct Baz;\n')
+    # A definition doesn't refer to its own tag
+    assert result['Bar'] == ([('tag', 'Bar')], [('name', 'int')])
+    # A typedef declares just its name
+    assert result['Bar2'] == ([('name', 'Bar2')], [('tag', 'Bar')])
+    assert result['Baz'] == ([('tag', 'Baz')], [])
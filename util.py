@@ -1,9 +1,19 @@
 from __future__ import print_function
 
 import sys
+import os
 import io
 import re
 import itertools
+import pickle
+import copyreg
+import hashlib
+import time
+import threading
+import heapq
+import contextlib
+import functools
+import collections
 import textwrap
 from pathlib import Path
 
@@ -14,13 +24,19 @@ except NameError:
 here = Path(script_name).resolve().parent
 
 
-sys.path.insert(0, str(here/'pycparser'))
+# Use the pycparser submodule, if it's there
+if (here/'pycparser'/'pycparser').is_dir():
+    sys.path.insert(0, str(here/'pycparser'))
 
 
-import pycparser, pycparser.c_generator, pycparser.c_ast, pycparser.plyparser
+import pycparser, pycparser.c_ast, pycparser.plyparser
 
+from cache import digest
+from source import split_chunks, split_statements
 
 
+
+@functools.lru_cache(maxsize=1 << 16)
 def to_snake(s):
     # Change the string into snake_case
     s = re.sub('[A-Z](?![A-Z0-9_]|$)', lambda m: '_' + m.group(0).lower(), s)
@@ -32,6 +48,7 @@ def to_snake_upper(s):
     # Change the string into SNAKE_CASE
     return to_snake(s).upper()
 
+@functools.lru_cache(maxsize=1 << 16)
 def to_capitals(s):
     # Change the string into CamelCase
     s = re.sub(r'_([a-zA-Z])', lambda m: m.group(1).upper(), s)
@@ -53,17 +70,23 @@ def err(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
 
+@functools.lru_cache(maxsize=16)
+def _source_lines(path, mtime):
+    with io.open(path) as f:
+        return f.readlines()
+
 def debug_source(path, line_start, line_end=None):
     # Output relevant source code
-    with io.open(str(path)) as f:
-        lines = list(enumerate(f, 1))
+    # The lines of recently used files are kept, as long as the files are unchanged
+    path = str(path)
+    lines = _source_lines(path, os.stat(path).st_mtime)
     real_line_end = line_end
     if line_end is None:
         line_end = line_start+4
         real_line_end = line_start
     return ''.join(
-        str(i) + (':' if line_start <= i <= real_line_end else ' ') + '\t' + l
-        for i, l in lines[line_start-1-1:line_end+1]
+        str(i) + (':' if line_start <= i <= real_line_end else ' ') + '\t' + lines[i-1]
+        for i in range(max(line_start-1, 1), min(line_end+1, len(lines))+1)
     ).strip('\n')
 
 def debug_source_ast(ast):
@@ -78,18 +101,153 @@ def debug_source_ast(ast):
     return debug_source(ast.coord.file, min(lines), max(lines))
 
 
-def parse_c(src):
+# Pickle AST nodes as calls to their constructors instead of the default state dicts.
+# This halves the size and loading time, which matters for cached and parallel-parsed ASTs.
+def _reduce_slots(obj):
+    cls = type(obj)
+    return cls, tuple(getattr(obj, name) for name in cls.__slots__[:-1])
+
+for cls in pycparser.c_ast.Node.__subclasses__() + [pycparser.plyparser.Coord]:
+    # Generated node classes have `__slots__` = constructor arguments + '__weakref__'
+    if cls.__dict__.get('__slots__', ())[-1:] == ('__weakref__',):
+        copyreg.pickle(cls, _reduce_slots)
+
+
+class CParser(pycparser.CParser):
+    # pycparser's parser, which can also be told the typedef names declared before the code it parses
+    def parse(self, text, filename='', debuglevel=0, typedefs=()):
+        self.clex.filename = filename
+        self.clex.reset_lineno()
+        self._scope_stack = [dict.fromkeys(typedefs, True)]
+        self._last_yielded_token = None
+        return self.cparser.parse(
+            input=text,
+            lexer=self.clex,
+            debug=debuglevel)
+
+_parser = None
+# The parser can't be used by several threads at once
+parser_lock = threading.RLock()
+
+def get_parser():
+    # Build the parser once per process and reuse it for every parse
+    # The first time, PLY generates its tables and saves them in pycparser's package as lextab.py and yacctab.py,
+    # where they are found afterwards
+    global _parser
+    with parser_lock:
+        if _parser is None:
+            _parser = CParser(taboutputdir=os.path.dirname(pycparser.__file__))
+    return _parser
+
+
+def _parse_chunk(chunk):
+    src, typedefs = chunk
+    return get_parser().parse(src, typedefs=typedefs).ext
+
+def parse_parallel(src, jobs):
+    # Parse pieces of the source in separate processes and join the results
+    import concurrent.futures
+    chunks = split_chunks(src, jobs * 2)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=get_parser) as executor:
+        ext = []
+        for chunk_ext in executor.map(_parse_chunk, chunks):
+            ext.extend(chunk_ext)
+    return pycparser.c_ast.FileAST(ext, ext[0].coord if ext else None)
+
+
+def parse_recovering(src, errors):
+    # Parse the statements that can be parsed and leave out the rest:
+    # bisect the source at top-level statement boundaries until each failing statement is found alone,
+    # and append its error to `errors`
+    statements, typedefs = split_statements(src)
+    parser = get_parser()
+    ext = []
+    # Ranges of statements to parse, the next one at the end
+    todo = [(0, len(statements))]
+    while todo:
+        start, end = todo.pop()
+        code = ''.join(code for code, typedef_count in statements[start:end])
+        try:
+            ext.extend(parser.parse(code, typedefs=typedefs[:statements[start][1]]).ext)
+        except pycparser.plyparser.ParseError as e:
+            if end - start == 1:
+                errors.append(str(e))
+            else:
+                middle = (start + end) // 2
+                todo.append((middle, end))
+                todo.append((start, middle))
+    return pycparser.c_ast.FileAST(ext, ext[0].coord if ext else None)
+
+
+def parse_c(src, cache=None, jobs=None, errors=None, quiet=False):
     # Parse C source code into AST
+    # With a `Cache`, the AST is stored pickled and reused for identical source,
+    # as long as pycparser's version (which determines the AST's shape) is the same
+    # With `jobs` > 1, the source is split and parsed in that many processes
+    # If `errors` is a list, a parse error doesn't stop the parse: top-level statements that fail are left out
+    # and their errors are appended to it (see `parse_recovering`)
+    # Unless `quiet`, the source around a parse error is printed before raising it
+    recover = errors is not None
+    if cache:
+        key = digest('ast', pycparser.__version__, pickle.HIGHEST_PROTOCOL, recover, src)
+        data = cache.get(key)
+        if data is not None:
+            try:
+                result, cached_errors = pickle.loads(data)
+            except Exception:
+                pass
+            else:
+                if recover:
+                    errors.extend(cached_errors)
+                return result
+    new_errors = []
+    result = None
+    if jobs and jobs > 1:
+        try:
+            result = parse_parallel(src, jobs)
+        except pycparser.plyparser.ParseError:
+            # Maybe the source was split wrongly; the serial parse will report the error if there is one
+            err("Parallel parsing failed, parsing again serially")
     try:
-        return pycparser.CParser().parse(src)
+        if result is None:
+            with parser_lock:
+                try:
+                    result = get_parser().parse(src)
+                except pycparser.plyparser.ParseError:
+                    if not recover:
+                        raise
+                    result = parse_recovering(src, new_errors)
     except pycparser.plyparser.ParseError as e:
         exc = e
+    else:
+        if cache:
+            try:
+                cache.put(key, pickle.dumps((result, new_errors), pickle.HIGHEST_PROTOCOL))
+            except RuntimeError:
+                # Too deeply nested to pickle (RecursionError)
+                pass
+        if recover:
+            errors.extend(new_errors)
+        return result
+    context = not quiet and debug_parse_error(str(exc))
+    if context:
+        err(context)
+    raise pycparser.plyparser.ParseError(str(exc))
+
+def debug_parse_error(message):
+    # Output the source code where a parse error happened, or '' if it can't be found
     try:
-        m = re.search(r'^(.+?):([0-9]+):[0-9]+:', str(exc))
-        err(debug_source(m.group(1), int(m.group(2))))
+        m = re.search(r'^(.+?):([0-9]+):[0-9]*:?', message)
+        return debug_source(m.group(1), int(m.group(2)))
     except Exception:
-        pass
-    raise pycparser.plyparser.ParseError(str(exc))
+        return ''
+
+
+def parse_depfile(text):
+    # Get the list of prerequisites from a Make-style dependency file
+    text = text.replace('\\\n', ' ')
+    deps = text.partition(': ')[2]
+    return [dep.replace('\\ ', ' ') for dep in re.findall(r'(?:\\ |\S)+', deps)]
 
 
 def internal(path):
@@ -133,10 +291,140 @@ def _debug_ast(node, skip=False):
 
 
 
+def ast_digest(node):
+    # Hash an AST by its structure and values, ignoring where in the source it came from
+    h = hashlib.sha1()
+    def visit(node):
+        h.update(type(node).__name__.encode('utf-8') + b'(')
+        for key in node.attr_names:
+            h.update('{}={!r};'.format(key, getattr(node, key)).encode('utf-8'))
+        for key, child in node.children():
+            h.update(key.encode('utf-8') + b':')
+            visit(child)
+        h.update(b')')
+    visit(node)
+    return h.hexdigest()
+
+
+def top_name(top):
+    # The C name of a top-level declaration, if it has one
+    if isinstance(top, pycparser.c_ast.FuncDef):
+        top = top.decl
+    return getattr(top, 'name', None) or getattr(top.type, 'name', None)
+
+
+class _SymbolVisitor(pycparser.c_ast.NodeVisitor):
+    def __init__(self, outer):
+        # The struct, union or enum that the top-level declaration is just about (`struct T;`), if any
+        self.outer = outer
+        self.declares = set()
+        self.references = set()
+
+    def visit_IdentifierType(self, node):
+        self.references.update(('name', name) for name in node.names)
+
+    def visit_ID(self, node):
+        self.references.add(('name', node.name))
+
+    def visit_Enumerator(self, node):
+        self.declares.add(('name', node.name))
+        self.generic_visit(node)
+
+    def visit_tag(self, node, members):
+        if node.name:
+            if members is not None or node is self.outer:
+                self.declares.add(('tag', node.name))
+            else:
+                # Such as `typedef struct T U;`, which declares just U
+                self.references.add(('tag', node.name))
+        self.generic_visit(node)
+
+    def visit_Struct(self, node):
+        self.visit_tag(node, node.decls)
+
+    def visit_Union(self, node):
+        self.visit_tag(node, node.decls)
+
+    def visit_Enum(self, node):
+        self.visit_tag(node, node.values)
+
+def symbol_keys(top):
+    # Names that a top-level declaration declares and refers to, as sorted lists of ('tag', name) for structs,
+    # unions and enums and ('name', name) for everything else (C keeps them apart)
+    visitor = _SymbolVisitor(top.type if isinstance(top, pycparser.c_ast.Decl) else None)
+    if isinstance(top, pycparser.c_ast.FuncDef):
+        # Just the signature; what the body uses isn't needed for the function to be declared
+        top = top.decl
+    visitor.visit(top)
+    # Declarations of just a struct (etc.) have no name of their own
+    if top.name:
+        visitor.declares.add(('name', top.name))
+    # A struct that refers to itself, through a pointer, doesn't need anything more for that
+    return sorted(visitor.declares), sorted(visitor.references - visitor.declares)
+
+
+def peak_rss():
+    # Peak resident memory of this process in bytes, or None if unknown
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+class Stats(object):
+    # Timings and counters of a run, reported by --profile
+    def __init__(self, slowest=10):
+        self.phases = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+        self.kinds = collections.Counter()
+        # Heap of (seconds, kind, name) of the slowest declarations
+        self.slowest = []
+        self.slowest_count = slowest
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = {
+                'seconds': time.perf_counter() - start,
+                # The peak of the whole process up to the end of this phase
+                'peak_rss': peak_rss(),
+            }
+
+    def count(self, key, n=1):
+        self.counters[key] = self.counters.get(key, 0) + n
+
+    def declaration(self, kind, name, seconds):
+        if kind:
+            self.kinds[kind] += 1
+        item = (seconds, kind or '', name or '')
+        if len(self.slowest) < self.slowest_count:
+            heapq.heappush(self.slowest, item)
+        elif item > self.slowest[0]:
+            heapq.heapreplace(self.slowest, item)
+
+    def as_dict(self):
+        return collections.OrderedDict([
+            ('phases', self.phases),
+            ('counters', self.counters),
+            ('kinds', dict(self.kinds)),
+            ('slowest', [
+                {'seconds': seconds, 'kind': kind, 'name': name}
+                for seconds, kind, name in sorted(self.slowest, reverse=True)
+            ]),
+        ])
+
+
 def generate_c(ast):
     # Generate C code from AST
     if isinstance(ast, pycparser.c_ast.Node):
-        return pycparser.c_generator.CGenerator().visit(ast)
+        # Imported here, because many runs don't need it
+        from pycparser.c_generator import CGenerator
+        return CGenerator().visit(ast)
     return ast
 
 